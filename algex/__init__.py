@@ -1,17 +1,64 @@
+import itertools
+
 from .symbol import S
 from .transform import Transform
 from .error_handler import ErrorHandler
 from .nullable import Nullable
 
-from .intermediate import MemoryIntermediate
+from .intermediate import MemoryIntermediate, PythonIntermediate, NumpyIntermediate, default_intermediate
 from .solver import solver, Eqn
-from .substitute import substitute
+from .substitute import substitute, substitute_many
+from .compiler import compile, CompiledTemplate
+from .misc import doc_id, NoMatchException
+from .stream import iter_json, write_json, write_jsonl, is_source
+from .parallel import solve_concurrently, solve_parallel
+from .pool import IntermediatePool
+from .instrument import Observer, StatsCollector, timed
+from .direct import transform
+from .aio import async_solve, async_substitute
+
+def solve(template, data, intermediate=None):
+    if is_source(data):
+        # A path or file containing a JSON array or JSON-lines, read one element at a time
+        data = iter_json(data)
+    if intermediate is None:
+        intermediate = default_intermediate(data)
+    
+    if isinstance(template, CompiledTemplate):
+        # Template was already walked once by compile(), just run it on the data
+        return template(data, intermediate)
 
-def solve(template, data):
     if not isinstance(template, list):
         # Outermost level should always be wrapped in a list
         template = [template]
         data = [data]
-    
-    intermediate = MemoryIntermediate()
+
     return solver(Eqn(template, data), intermediate)
+
+def solve_many(template, docs, intermediate=None):
+    '''Solve template against each of docs, packing all of them into a single intermediate so that
+    build and query costs are paid once per batch rather than once per document.
+    Use substitute_many() to get results back out, one list per document.'''
+    if isinstance(template, CompiledTemplate):
+        template = template.template[0] if template.wrapped else template.template
+    if is_source(docs):
+        docs = iter_json(docs)
+    if intermediate is None:
+        intermediate = default_intermediate(docs)
+    
+    # Each document becomes one row of an outer table, tagged with its position in docs
+    batch_template = compile([{'_doc_id': doc_id, 'doc': template}])
+    counter = itertools.count()
+    def tagged(docs):
+        for doc in docs:
+            yield {'_doc_id': next(counter), 'doc': doc}
+    
+    # Same steps as batch_template(), except that no document matching (or no documents at all) is fine
+    timed(intermediate, 'build', intermediate.build, batch_template.template)
+    try:
+        timed(intermediate, 'solve', batch_template.solve, tagged(docs), intermediate)
+    except NoMatchException:
+        pass  # Only the outer list raises, after every document was tried; each one gets []
+    timed(intermediate, 'finish', intermediate.finish)
+    intermediate.documents = next(counter)
+    return intermediate
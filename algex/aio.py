@@ -0,0 +1,70 @@
+import asyncio
+from itertools import islice
+
+from .substitute import substitute
+
+# asyncio versions of solve() and substitute(). The solver and queries are plain blocking code, so
+# they run on an executor; async iterables in the data are read on the event loop, one item ahead of
+# the solver, so fetching the next page overlaps with solving the current one.
+
+done = object()  # Returned instead of raising StopAsyncIteration across threads
+
+async def next_item(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return done
+
+class SyncIterator:
+    # Blocking iterator over an async iterable, for use from the solver's thread
+    def __init__(self, iterable, loop):
+        self.iterator = iterable.__aiter__()
+        self.loop = loop
+        self.pending = None
+
+    def fetch(self):
+        return asyncio.run_coroutine_threadsafe(next_item(self.iterator), self.loop)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pending is None:
+            self.pending = self.fetch()
+        item = self.pending.result()
+        if item is done:
+            raise StopIteration
+        self.pending = self.fetch()  # Start on the next item while this one is solved
+        return sync_data(item, self.loop)
+
+def sync_data(data, loop):
+    # Swap every async iterable in data for a SyncIterator, copying only the parts that contain one
+    if hasattr(data, '__aiter__'):
+        return SyncIterator(data, loop)
+    if isinstance(data, dict):
+        converted = {k: sync_data(v, loop) for k, v in data.items()}
+        return data if all(converted[k] is v for k, v in data.items()) else converted
+    if isinstance(data, list):
+        converted = [sync_data(v, loop) for v in data]
+        return data if all(new is old for new, old in zip(converted, data)) else converted
+    return data
+
+async def async_solve(template, data, intermediate=None, executor=None):
+    '''Same as solve(), but data may contain async iterables (e.g. pages fetched over HTTP) at any
+    list position, including the top level. The solve itself runs on executor (the loop's default
+    if None), so the event loop stays free while it does.'''
+    from . import solve  # Avoid circular import
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, solve, template, sync_data(data, loop), intermediate)
+
+async def async_substitute(template, solutions, executor=None, batch_size=100):
+    '''Async generator version of substitute(). Queries run on executor, batch_size results at a time.'''
+    loop = asyncio.get_running_loop()
+    results = substitute(template, solutions)
+    while True:
+        batch = await loop.run_in_executor(executor, lambda: list(islice(results, batch_size)))
+        for result in batch:
+            yield result
+        if len(batch) < batch_size:
+            return
@@ -0,0 +1,128 @@
+from .symbol import S
+from .transform import Transform
+from .error_handler import ErrorHandler
+from .misc import root, parent_id, NoMatchException
+from .sqlizer import template_info
+from .instrument import timed
+
+# Compiles a template into a tree of closures which walk the data directly.
+# Each closure has the signature solve(rhs, intermediate) and behaves exactly like
+# the corresponding Solver rule, but all dispatch and table naming happens once,
+# at compile time, rather than once per node of the data.
+
+def compile_symbol(lhs, table, info):
+    def solve_symbol(rhs, intermediate):
+        return {lhs: rhs}
+    return solve_symbol
+
+def compile_transform(lhs, table, info):
+    solve = compile_node(lhs.x, table, info)
+    inverse = lhs.inv
+    def solve_transform(rhs, intermediate):
+        # We have f(x) = rhs, so to solve it, we solve x = inv(rhs)
+        return solve(inverse(rhs), intermediate)
+    return solve_transform
+
+def compile_error_handler(lhs, table, info):
+    solve = compile_node(lhs.x, table, info)
+    handle_error = lhs.handle_error
+    nested = [t for t in info.nested[(table, id(lhs))] if t != root]
+    def solve_error_handler(rhs, intermediate):
+        sizes = {t: intermediate.size(t) for t in nested}
+        try:
+            return solve(rhs, intermediate)
+        except Exception as e:
+            intermediate.truncate(sizes)
+            for observer in intermediate.observers:
+                observer.on_error_handled(intermediate, table, lhs, e)
+            return handle_error(e, intermediate, table, rhs)
+    return solve_error_handler
+
+def compile_dict(lhs, table, info):
+    if lhs and all(isinstance(v, S) for v in lhs.values()):
+        # Common case: a flat record of symbols, no recursion needed
+        symbols = list(lhs.items())
+        def solve_flat_dict(rhs, intermediate):
+            get = rhs.get
+            return {v: get(k, None) for k, v in symbols}
+        return solve_flat_dict
+
+    items = [(k, compile_node(v, table, info)) for k, v in lhs.items()]
+    def solve_dict(rhs, intermediate):
+        solution = {}
+        for k, solve in items:
+            solution.update(solve(rhs.get(k, None), intermediate))
+        return solution
+    return solve_dict
+
+def compile_list(lhs, table, info):
+    elements = [(info.table(table, item), compile_node(item, info.table(table, item), info),
+                 info.descendants[info.table(table, item)]) for item in lhs]
+    def solve_list(rhs, intermediate):
+        parent_row = intermediate.size(table)
+
+        # Same loop structure as Solver.solve_list: walk rhs only once
+        matched = [False for element in elements]
+        for value in rhs:
+            for ind, (current_table, solve, descendants) in enumerate(elements):
+                sizes = {t: intermediate.size(t) for t in descendants}
+                try:
+                    solution = solve(value, intermediate)
+                except NoMatchException:
+                    # This is the filter functionality
+                    intermediate.truncate(sizes)
+                    for observer in intermediate.observers:
+                        observer.on_no_match(intermediate, current_table, lhs[ind])
+                    continue
+                matched[ind] = True
+                solution[parent_id] = parent_row
+                intermediate.append(current_table, solution)
+
+        for ind, found in enumerate(matched):
+            if not found:
+                raise NoMatchException('No match found for:', lhs[ind])
+        return {}
+    return solve_list
+
+def compile_match(lhs, table, info):
+    def check_match(rhs, intermediate):
+        if lhs != rhs:
+            raise NoMatchException('LHS does not match data:', lhs)
+        return {}
+    return check_match
+
+# Same order as Solver's cases
+cases = [(S, compile_symbol),
+         (Transform, compile_transform),
+         (ErrorHandler, compile_error_handler),
+         (dict, compile_dict),
+         (list, compile_list)]
+
+def compile_node(lhs, table, info):
+    for tp, rule in cases:
+        if isinstance(lhs, tp):
+            return rule(lhs, table, info)
+    return compile_match(lhs, table, info)
+
+class CompiledTemplate:
+    def __init__(self, template):
+        # Outermost level should always be wrapped in a list, same as solve()
+        self.wrapped = not isinstance(template, list)
+        self.template = [template] if self.wrapped else template
+        self.solve = compile_node(self.template, root, template_info(self.template))
+
+    def __call__(self, data, intermediate):
+        if self.wrapped:
+            data = [data]
+        timed(intermediate, 'build', intermediate.build, self.template)
+        timed(intermediate, 'solve', self.solve, data, intermediate)
+        timed(intermediate, 'finish', intermediate.finish)
+        return intermediate
+
+    def __repr__(self):
+        return 'compile(' + repr(self.template[0] if self.wrapped else self.template) + ')'
+
+def compile(template):
+    '''Compile a template once, so it can be passed to solve() many times without re-walking it.
+    Table names come from the template's structure, so they match what solve() would use.'''
+    return CompiledTemplate(template)
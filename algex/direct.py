@@ -0,0 +1,128 @@
+from .compiler import compile, CompiledTemplate
+from .intermediate import PythonIntermediate
+from .misc import root
+from .sqlizer import template_info
+from .substitute import substitute, get_outer_symbols, get_nested_templates, assign, Groups, GroupedSolutions
+
+# Direct path for transform(): when the match template has no repeated symbols, there are no joins to
+# do. Each list level of the output template then just reads along one chain of tables (root down to
+# the deepest table holding its symbols), so its solutions can be read straight off the solved rows
+# in a single pass, without planning or running queries.
+
+class Level:
+    # One list level of the output template, and where to find its symbols
+    def __init__(self, template, symbols, chain, nested):
+        self.template = template
+        self.symbols = symbols  # Context symbols (from enclosing levels), then this level's own
+        self.chain = chain  # Tables from the top of the match template down to the deepest one needed
+        self.nested = nested  # id(nested list template) -> Level
+
+class NotDirect(Exception):
+    pass  # Output template needs joins the direct path can't do
+
+def plan_level(template, context, context_table, info, tables):
+    symbols = list(context)
+    for sym in get_outer_symbols(template):
+        if sym not in symbols:
+            symbols.append(sym)
+
+    # Every table we need must be on one chain from root, extending the enclosing level's chain
+    deepest = context_table
+    for sym in symbols:
+        if sym not in tables:
+            raise NotDirect('Symbol not in match template:', sym)
+        table = tables[sym]
+        if table in ancestors(deepest, info.parents):
+            continue
+        if deepest not in ancestors(table, info.parents):
+            raise NotDirect('Symbols on different branches:', symbols)
+        deepest = table
+    chain = ancestors(deepest, info.parents)[::-1][1:]
+
+    nested = {}
+    for subtree in get_nested_templates(template):
+        if id(subtree) not in nested:
+            nested[id(subtree)] = plan_level(subtree, symbols, deepest, info, tables)
+    return Level(template, symbols, chain, nested)
+
+def ancestors(table, parents):
+    # table, its parent, ..., root
+    result = [table]
+    while table != root:
+        table = parents[table]
+        result.append(table)
+    return result
+
+def level_solutions(level, sink):
+    # Distinct values of level.symbols, in the same order a query would return them
+    values = [()]  # Values so far for each row of the current table; root has a single row
+    order = []
+    for table in level.chain:
+        own = [sym for sym in level.symbols if sym in sink.positions[table]]
+        positions = [sink.positions[table][sym] for sym in own]
+        order += own
+        # values[_id] for every row: rows of failed elements are truncated, so every parent exists
+        parent_values = values
+        values = [parent_values[row[0]] + tuple(row[i] for i in positions) for row in sink.rows[table]]
+    permutation = [order.index(sym) for sym in level.symbols]
+    if permutation == sorted(permutation):
+        permutation = None  # Already in the right order
+
+    seen, seen_unhashable = set(), []
+    for value in values:
+        if permutation is not None:
+            value = tuple(value[i] for i in permutation)
+        try:
+            if value in seen:
+                continue
+            seen.add(value)
+        except TypeError:
+            if value in seen_unhashable:
+                continue
+            seen_unhashable.append(value)
+        yield value
+
+def assemble(level, sink):
+    # Same as substitute_grouped(), with level_solutions() in place of queries
+    nested = {}
+    for key, subtree in level.nested.items():
+        groups = Groups()
+        for values, result in assemble(subtree, sink):
+            groups.add(values[:len(level.symbols)], result)
+        nested[key] = groups
+    for values in level_solutions(level, sink):
+        soln = dict(zip(level.symbols, values))
+        yield values, assign(level.template, GroupedSolutions(nested, values), soln)
+
+class DirectTransform:
+    def __init__(self, in_template, out_template):
+        self.compiled = in_template if isinstance(in_template, CompiledTemplate) else compile(in_template)
+        self.out_template = out_template
+        info = template_info(self.compiled.template)
+        self.level = None
+        tables = {}
+        for table, symbols in info.symbol_directory.items():
+            for sym in symbols:
+                if table != root:
+                    tables.setdefault(sym, []).append(table)
+        if all(len(t) == 1 for t in tables.values()):
+            try:
+                self.level = plan_level(out_template, [], root, info, {sym: t[0] for sym, t in tables.items()})
+            except NotDirect:
+                pass
+        self.direct = self.level is not None
+
+    def __call__(self, data):
+        if not self.direct:
+            # Needs joins, so go through the usual solve + substitute
+            from . import solve  # Avoid circular import
+            return list(substitute(self.out_template, solve(self.compiled, data)))
+        sink = self.compiled(data, PythonIntermediate())  # Just collects rows, no queries are run on it
+        return [result for values, result in assemble(self.level, sink)]
+
+def transform(in_template, out_template):
+    '''Compile a mapping from data matching in_template to the list of results substitute(out_template, ...)
+    would give. When in_template has no repeated symbols and each list level of out_template reads from a
+    single branch of in_template, results are assembled straight from the matched rows, with no queries;
+    otherwise this falls back to solve() + substitute().'''
+    return DirectTransform(in_template, out_template)
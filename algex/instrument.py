@@ -0,0 +1,110 @@
+import threading
+import time
+import weakref
+
+# Observers get told about what the solver and intermediates are doing. Attach one with
+# intermediate.observe(observer); solve() and substitute() then report everything that
+# happens to that intermediate. With no observers attached, the hooks cost next to nothing.
+
+class Observer:
+    '''Base class for instrumentation hooks. Override whichever methods you need.'''
+    def on_phase(self, intermediate, phase, seconds):
+        pass  # phase is one of 'build', 'solve', 'finish' (from the solver), 'flush', 'index' (from SQLIntermediate)
+
+    def on_query(self, intermediate, statement, params, seconds, rows):
+        pass  # One SQL query run by query(), with the number of rows it returned
+
+    def on_no_match(self, intermediate, table, lhs):
+        pass  # A list element lhs didn't match some data, so it was filtered out of table
+
+    def on_error_handled(self, intermediate, table, handler, error):
+        pass  # An ErrorHandler (e.g. Nullable) caught error and fell back
+
+def timed(intermediate, phase, f, *args):
+    # Run f(*args), reporting how long it took to the intermediate's observers
+    if not intermediate.observers:
+        return f(*args)
+    start = time.perf_counter()
+    result = f(*args)
+    seconds = time.perf_counter() - start
+    for observer in intermediate.observers:
+        observer.on_phase(intermediate, phase, seconds)
+    return result
+
+# Statements are cached and reused by SQLIntermediate, so only compile each one to a string once
+sql_cache = weakref.WeakKeyDictionary()
+sql_cache_lock = threading.Lock()
+
+def get_sql(statement, intermediate):
+    with sql_cache_lock:
+        if statement not in sql_cache:
+            sql_cache[statement] = str(statement.compile(dialect=intermediate.engine.dialect))
+        return sql_cache[statement]
+
+class StatsCollector(Observer):
+    '''Built-in observer which summarizes everything it sees, per template. Can be attached to many
+    intermediates at once, e.g. one per request. With explain=True, the query plan of each distinct
+    SQL query is captured the first time it runs.'''
+    def __init__(self, explain=False, slowest=5):
+        self.explain = explain
+        self.slowest = slowest  # How many of the slowest queries to keep per template
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get_stats(self, intermediate):
+        info = getattr(intermediate, 'template_info', None)
+        key = info.schema_key if info is not None else None
+        if key not in self.templates:
+            self.templates[key] = {'template': repr(info.template) if info is not None else None,
+                                   'solves': 0,
+                                   'phase_seconds': {},
+                                   'rows': {},
+                                   'queries': 0,
+                                   'query_seconds': 0.,
+                                   'query_rows': 0,
+                                   'slowest_queries': [],
+                                   'query_plans': {},
+                                   'no_matches': 0,
+                                   'errors_handled': 0}
+        return self.templates[key]
+
+    def on_phase(self, intermediate, phase, seconds):
+        with self.lock:
+            stats = self.get_stats(intermediate)
+            stats['phase_seconds'][phase] = stats['phase_seconds'].get(phase, 0.) + seconds
+            if phase == 'finish':
+                stats['solves'] += 1
+                for table in intermediate.parents:
+                    stats['rows'][table.s] = stats['rows'].get(table.s, 0) + intermediate.size(table)
+
+    def on_query(self, intermediate, statement, params, seconds, rows):
+        sql = get_sql(statement, intermediate)
+        with self.lock:
+            need_plan = self.explain and sql not in self.get_stats(intermediate)['query_plans']
+        plan = intermediate.explain(statement, params) if need_plan else None
+        with self.lock:
+            stats = self.get_stats(intermediate)
+            stats['queries'] += 1
+            stats['query_seconds'] += seconds
+            stats['query_rows'] += rows
+            if plan is not None:
+                stats['query_plans'][sql] = plan
+            slowest = stats['slowest_queries']
+            slowest.append({'sql': sql, 'seconds': seconds, 'rows': rows})
+            slowest.sort(key=lambda query: -query['seconds'])
+            del slowest[self.slowest:]
+
+    def on_no_match(self, intermediate, table, lhs):
+        with self.lock:
+            self.get_stats(intermediate)['no_matches'] += 1
+
+    def on_error_handled(self, intermediate, table, handler, error):
+        with self.lock:
+            self.get_stats(intermediate)['errors_handled'] += 1
+
+    def summary(self):
+        '''Stats for each template seen so far, as a list of dicts.'''
+        with self.lock:
+            return [dict(stats, phase_seconds=dict(stats['phase_seconds']), rows=dict(stats['rows']),
+                         slowest_queries=list(stats['slowest_queries']), query_plans=dict(stats['query_plans']))
+                    for stats in self.templates.values()]
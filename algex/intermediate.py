@@ -1,12 +1,20 @@
+import os
+import pickle
+import time
+from collections import OrderedDict
 from functools import reduce
 
 from .symbol import S, InternalSymbol
-from .sqlizer import get_tree_structure, get_symbol_directory, root #, build_schema
+from .instrument import timed
+from .sqlizer import template_info, get_schema_key, get_table_order, root #, build_schema
+from .misc import parent_id
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, ForeignKey
+from sqlalchemy import Column, Integer, ForeignKey, Index, select, bindparam, func
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.types import UserDefinedType
 
 
 data = [{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}], 'houses':[{'state': 'CT'}]},
@@ -21,6 +29,13 @@ everything  = Everything()
 
 
 class Intermediate:
+    observers = ()  # See instrument.py
+    
+    def observe(self, observer):
+        # Report solves and queries on this intermediate to observer, see instrument.Observer
+        self.observers = list(self.observers) + [observer]
+        return observer
+    
     def build(self, lhs):
         return  # By default, build step does nothing
     
@@ -33,6 +48,19 @@ class Intermediate:
     def size(self, table):
         pass  # Only query which needs to work *before* calling finish()
     
+    def truncate(self, sizes):
+        pass  # Drop rows appended since: {table: size(table) back then}. Used when a partly solved element doesn't match
+    
+    def extend(self, data):
+        '''Solve data - a list of new top-level elements for the same template - and add the solutions to
+        the ones already here, without solving everything again. Returns the values of the outer symbols
+        (those not inside any list) of each new match, e.g. to re-render just the outputs they affect
+        with substitute(output_template, intermediate, known_values).'''
+        from .solver import solver  # Avoid circular import
+        if getattr(self, 'template_info', None) is None:
+            raise ValueError("extend() needs the template this was solved with, which open() doesn't have")
+        return solver.extend(self, data)
+    
     def __iter__(self):
         # Method to iterate through ALL solutions. Note that there may be exponentially many!
         # Should not include InternalSymbols
@@ -74,72 +102,392 @@ class Canonicalizer(dict):
         return non_tree_constraints, repeated_symbols
 
 class SQLIntermediate(Intermediate):
-    def __init__(self, types={}, engine=None):
+    def __init__(self, types={}, engine=None, flush_threshold=10000, statement_cache_size=128, index_symbols=(),
+                 prune=False):
         self.Base = declarative_base()
         self.types = types
+        self.statement_cache_size = statement_cache_size
+        # Symbols which will be passed to query() as known values, so should be indexed up front.
+        # Any others are indexed the first time they're used as known values.
+        self.index_symbols = list(index_symbols)
+        # Max number of rows to hold python-side before writing them to the db. None = hold everything until finish()
+        self.flush_threshold = flush_threshold
+        # Drop rows which can't be part of any solution before loading them, see prune_rows().
+        # Needs every row python-side at once, so nothing is flushed before finish().
+        self.prune = prune
+        if prune:
+            self.flush_threshold = None
+        self.pruned = 0
         
         if engine is None:
-            engine = create_engine('sqlite:///:memory:')
+            # A single connection, usable from any thread, so the db outlives the thread that solved it
+            engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
         self.engine = engine
     
     def build(self, lhs):
-        # TODO: either taskify or memoize so we don't repeat work when subclasses need metadata first
-        try:
-            self.symbol_directory  # Check if subclass already computed directory
-        except:
-            self.symbol_directory = get_symbol_directory(lhs) # list symbols in each table
-        
+        self.template_info = template_info(lhs)
+        if getattr(self, 'schema_key', None) == self.template_info.schema_key:
+            # Already set up for this template (or one with the same tables): keep the schema,
+            # session and prepared statements, just throw away the old rows
+            self.reset()
+            return
+        self.setup(self.template_info.symbol_directory, self.template_info.parents)
+    
+    def setup(self, symbol_directory, parents):
+        # Everything build() does once the template has been walked. Also used by open(), where the
+        # directory and tree structure come from a saved file rather than a template.
+        self.schema_key = get_schema_key(symbol_directory, parents)
+        self.symbol_directory = symbol_directory # list symbols in each table
         self.reverse_symbol_directory = {} # list tables containing each symbol
         for table_sym in self.symbol_directory:
             for sym in self.symbol_directory[table_sym]:
                 self.reverse_symbol_directory.setdefault(sym, []).append(table_sym)
-        self.parents = get_tree_structure(lhs)
+        self.parents = parents
+        self.table_order = get_table_order(self.parents)
         
         self.model_classes = self.build_schema()
+        self.inserts = self.build_inserts()
         self.Base.metadata.create_all(self.engine)
         Session = sessionmaker(bind=self.engine)
         self.session = Session()
         
-        # Fake it until we make it
+        # Rows waiting to be written to the db, see flush()
         self.cache = {table: [] for table in self.model_classes}
+        self.cached = 0
+        self.flush_at = self.flush_threshold  # Next flush, once this many rows are cached
+        self.root_written = False
         # We need counts all the time while solving, so keep them python-side
         self.counts = {table: 0 for table in self.model_classes}
+        self.written = {table: 0 for table in self.model_classes}  # Rows of each table in the db
         
         self.canonicalizer = Canonicalizer(self.model_classes)
         self.non_tree_constraints, self.repeated_symbols = self.canonicalizer.get_non_tree_constraints()
+        
+        # Indexes are only created once the data is loaded, see finish()
+        self.indexes = set()
+        
+        # Prepared statements for query(), see get_statement()
+        self.statement_cache = OrderedDict()
+        self.statement_cache_hits = 0
+        self.statement_cache_misses = 0
     
     def build_schema(self):
         # Create sqlalchemy model classes for each table
         model_classes = {}
+        self.columns = {}
         for table in self.parents:
             parent = self.parents[table]
             attrs = {'__tablename__': table.s, 
                      '_id': Column(Integer, primary_key=True),
                      '_parent_id': Column(Integer, ForeignKey(parent.s + '._id'))}
             
-            attrs.update({symbol.s: Column(self.types[symbol], nullable=True, index=True) for symbol in self.symbol_directory[table]})
+            attrs.update({symbol.s: Column(self.types[symbol], nullable=True) for symbol in self.symbol_directory[table]})
             model = type(table.s, (self.Base,), attrs)  # This is how you create a class on-the-fly in Python
             model_classes[table] = model
+            # Cached rows are tuples: (_id, _parent_id, *symbols), in this order
+            self.columns[table] = [parent_id] + list(self.symbol_directory[table])
         model_classes[root] = type(root.s, (self.Base,), {'__tablename__': root.s, 
                      '_id': Column(Integer, primary_key=True)})
+        self.columns[root] = []
         return model_classes
     
+    def build_inserts(self):
+        # Raw INSERT statements for each table, so finish() can hand plain tuples straight to
+        # the DBAPI's executemany() without building ORM objects
+        inserts = {}
+        for table, model in self.model_classes.items():
+            column_names = ['_id'] + [sym.s for sym in self.columns[table]]
+            compiled = model.__table__.insert().compile(dialect=self.engine.dialect, column_keys=column_names)
+            if compiled.positional:
+                order = [column_names.index(name) for name in compiled.positiontup]
+                inserts[table] = (str(compiled), order, None)
+            else:
+                inserts[table] = (str(compiled), None, column_names)
+        return inserts
+    
+    def make_row(self, table, row):
+        # _id's are assigned python-side, in the same order the solver counts rows in
+        return (self.counts[table],) + tuple(row[sym] if sym in row else None for sym in self.columns[table])
+    
     def append(self, table, row):
-        self.cache[table].append(row)
+        self.cache[table].append(self.make_row(table, row))
         self.counts[table] += 1
+        self.cached += 1
+        if self.flush_at is not None and self.cached >= self.flush_at:
+            timed(self, 'flush', self.flush)
     
-    def finish(self):
-        model = self.model_classes[root]
-        self.session.add(model(**{'_id': 1}))  # TODO: for some reason autoincrement starts at 1???
-        for table, rows in self.cache.items():
-            # TODO: do we need to insert objects to parent tables before child tables?
+    def load(self, table, rows):
+        # Bulk insert row tuples with a single executemany()
+        statement, order, column_names = self.inserts[table]
+        if order is not None:
+            if order != sorted(order):
+                rows = [tuple(row[i] for i in order) for row in rows]
+        else:
+            rows = [dict(zip(column_names, row)) for row in rows]
+        self.session.connection().exec_driver_sql(statement, rows)
+    
+    def flush(self, everything=False):
+        # Write cached rows to the db and drop them python-side. The solver appends a row's children
+        # before the row itself, so while solving, rows whose parent isn't in the db yet are held back.
+        if not self.root_written:
+            # Outermost elements need a parent to point to, so we use a single root row with _id 0
+            self.load(root, [(0,)])
+            self.root_written = True
+            self.written[root] = 1
+        for table in self.table_order:
+            rows = self.cache[table]
+            # Rows are in _parent_id order, so the ones to hold back are at the end
+            end = len(rows)
+            if not everything:
+                written = self.written[self.parents[table]]
+                while end and rows[end - 1][1] >= written:
+                    end -= 1
+            if not end:
+                continue
+            self.load(table, rows[:end])
+            self.written[table] = rows[end - 1][0] + 1
+            self.cached -= end
+            self.cache[table] = rows[end:]
+        if self.flush_threshold is not None:
+            self.flush_at = self.cached + self.flush_threshold  # Not straight away again if lots are held back
+    
+    def reset(self):
+        # Delete all rows, leaving the tables, indexes and prepared statements in place for the next solve
+        if self.root_written:
+            connection = self.session.connection()
+            for table in reversed(self.table_order):
+                connection.execute(self.model_classes[table].__table__.delete())
+            connection.execute(self.model_classes[root].__table__.delete())
+            self.session.commit()
+        self.cache = {table: [] for table in self.model_classes}
+        self.cached = 0
+        self.flush_at = self.flush_threshold
+        self.root_written = False
+        self.counts = {table: 0 for table in self.model_classes}
+        self.written = {table: 0 for table in self.model_classes}
+        self.pruned = 0
+        if hasattr(self, 'documents'):
+            del self.documents
+    
+    def prune_rows(self):
+        # Semi-join pruning. Every query joins in all the tables holding repeated symbols (and their
+        # ancestors), so a row of one of those "required" tables is only ever part of a solution if:
+        #  - its parent is, and
+        #  - for each repeated symbol in it, every other table with that symbol has a row under the same
+        #    common ancestor row with the same value, and
+        #  - each required child table has at least one row under it.
+        # Rows failing any of these are dropped, along with everything under them, until nothing changes.
+        # _id's are left alone, so parent links stay valid and counts still give the next _id.
+        if not self.repeated_symbols:
+            return
+        column_index = {table: {sym: i + 1 for i, sym in enumerate(self.columns[table])} for table in self.parents}
+        required = set()
+        for sym in self.repeated_symbols:
+            for table in self.reverse_symbol_directory[sym]:
+                while table != root:
+                    required.add(table)
+                    table = self.parents[table]
+        
+        rows_by_id = {table: {row[0]: row for row in self.cache[table]} for table in self.parents}
+        # table -> {_id: _parent_id}, surviving rows only
+        alive = {table: {row[0]: row[1] for row in self.cache[table]} for table in self.parents}
+        def lineage(table):
+            result = [table]
+            while table != root:
+                table = self.parents[table]
+                result.append(table)
+            return result
+        def ancestor_ids(table, ids, ancestor):
+            # _id's of the rows of table ancestor which rows ids of table are under
+            while table != ancestor:
+                rows = rows_by_id[table]
+                ids = [rows[_id][1] for _id in ids]
+                table = self.parents[table]
+            return ids
+        
+        changed = True
+        while changed:
+            changed = False
+            for table in self.table_order:
+                # Children of dropped rows
+                parent = self.parents[table]
+                if parent == root:
+                    continue
+                ids = alive[table]
+                dead = [_id for _id, parent_id in ids.items() if parent_id not in alive[parent]]
+                for _id in dead:
+                    del ids[_id]
+                changed = changed or bool(dead)
+            
+            for sym in self.repeated_symbols:
+                tables = self.reverse_symbol_directory[sym]
+                for table in tables:
+                    for other in tables:
+                        if other == table:
+                            continue
+                        common = next(t for t in lineage(table) if t in lineage(other))
+                        ids, other_ids = list(alive[table]), list(alive[other])
+                        rows, i = rows_by_id[table], column_index[table][sym]
+                        other_rows, j = rows_by_id[other], column_index[other][sym]
+                        try:
+                            partners = set(zip(ancestor_ids(other, other_ids, common), [other_rows[_id][j] for _id in other_ids]))
+                            # None is NULL in the db, which never equals anything
+                            dead = [_id for _id, key in zip(ids, zip(ancestor_ids(table, ids, common), [rows[_id][i] for _id in ids]))
+                                    if key[1] is None or key not in partners]
+                        except TypeError:
+                            continue  # Unhashable values, leave it to the db
+                        for _id in dead:
+                            del alive[table][_id]
+                        changed = changed or bool(dead)
+            
+            for table in required:
+                # Parents without any rows in a required child table
+                parent = self.parents[table]
+                if parent == root:
+                    continue
+                has_child = set(alive[table].values())
+                ids = alive[parent]
+                dead = [_id for _id in ids if _id not in has_child]
+                for _id in dead:
+                    del ids[_id]
+                changed = changed or bool(dead)
+        
+        for table in self.parents:
+            rows = self.cache[table]
+            ids = alive[table]
+            self.cache[table] = [row for row in rows if row[0] in ids]
+            self.pruned += len(rows) - len(self.cache[table])
+        
+    def get_indexes(self):
+        # Indexes needed by the queries the template implies, as (model, column names) pairs:
+        #  - _parent_id everywhere, since every query joins children to their parents
+        #  - (_parent_id, symbol) for repeated symbols, so the join on them is a single lookup
+        #  - symbols we've been told will be known values
+        # Any other column is never filtered on, so indexing it would just slow down inserts.
+        indexes = []
+        for table in self.table_order:
             model = self.model_classes[table]
-            self.session.bulk_save_objects([model(**{k.s: v for k, v in row.items()}) for row in rows])
+            repeated = [sym for sym in self.symbol_directory[table] if sym in self.repeated_symbols]
+            if repeated:
+                indexes += [(model, ('_parent_id', sym.s)) for sym in repeated]
+            else:
+                indexes.append((model, ('_parent_id',)))
+        for sym in self.index_symbols:
+            indexes.append((self.canonicalizer[sym.s][0], (sym.s,)))
+        return indexes
+    
+    def create_index(self, model, column_names):
+        if (model, column_names) in self.indexes:
+            return
+        table = model.__table__
+        name = 'ix_' + '_'.join((table.name,) + column_names)
+        # checkfirst, since a reopened db already has its indexes
+        Index(name, *[table.c[column_name] for column_name in column_names]).create(self.session.connection(), checkfirst=True)
+        self.indexes.add((model, column_names))
+    
+    def create_indexes(self):
+        for model, column_names in self.get_indexes():
+            self.create_index(model, column_names)
+    
+    def extend(self, data):
+        if self.prune:
+            raise ValueError("Can't extend() a pruned intermediate: rows dropped earlier might match the new ones")
+        return super().extend(data)
+    
+    def finish(self):
+        # Can be called again after more rows are appended, see extend()
+        if self.prune:
+            timed(self, 'prune', self.prune_rows)
+        timed(self, 'flush', self.flush, True)
+        # Creating indexes after the bulk load is much cheaper than maintaining them on every insert
+        timed(self, 'index', self.create_indexes)
+        self.session.commit()
+    
+    def get_metadata(self):
+        # Everything open() needs, besides the tables themselves, to rebuild this intermediate
+        metadata = {'class': type(self),
+                    'types': self.types,
+                    'symbol_directory': self.symbol_directory,
+                    'parents': self.parents}
+        if hasattr(self, 'documents'):
+            metadata['documents'] = self.documents  # From solve_many()
+        return metadata
+    
+    def save_metadata(self, connection):
+        connection.execute('DROP TABLE IF EXISTS _algex_meta')
+        connection.execute('CREATE TABLE _algex_meta (key TEXT PRIMARY KEY, value BLOB)')
+        connection.executemany('INSERT INTO _algex_meta VALUES (?, ?)',
+                               [(key, pickle.dumps(value)) for key, value in self.get_metadata().items()])
+    
+    def save(self, path):
+        '''Copy the solved intermediate, along with everything needed to query it, into a sqlite file.
+        Use open(path) to reopen it later - e.g. in another process - and substitute() without solving again.'''
+        if self.engine.dialect.name != 'sqlite':
+            raise ValueError('save() needs a sqlite engine, not: ' + self.engine.dialect.name)
+        import sqlite3
+        
+        self.session.commit()
+        source = self.engine.raw_connection()
+        target = sqlite3.connect(os.fspath(path))
+        try:
+            source.driver_connection.backup(target)
+            with target:
+                self.save_metadata(target)
+        finally:
+            target.close()
+            source.close()
+    
+    @classmethod
+    def open(cls, path, **kwargs):
+        '''Reopen an intermediate written by save(). kwargs are passed to the constructor.'''
+        path = os.fspath(path)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)  # Otherwise sqlite would happily create an empty db
+        engine = create_engine('sqlite:///' + path, poolclass=StaticPool, connect_args={'check_same_thread': False})
+        with engine.connect() as connection:
+            metadata = {key: pickle.loads(value) for key, value in
+                        connection.exec_driver_sql('SELECT key, value FROM _algex_meta')}
+        
+        intermediate_class = metadata['class']
+        if not issubclass(intermediate_class, cls):
+            raise TypeError('File contains a ' + intermediate_class.__name__ + ', not a ' + cls.__name__)
+        intermediate = intermediate_class(types=metadata['types'], engine=engine, **kwargs)
+        intermediate.restore(metadata)
+        return intermediate
+    
+    def restore(self, metadata):
+        # Counterpart to get_metadata(): the tables already exist, so this just rebuilds python-side state
+        self.setup(metadata['symbol_directory'], metadata['parents'])
+        connection = self.session.connection()
+        for table, model in self.model_classes.items():
+            self.counts[table] = connection.execute(select(func.count()).select_from(model.__table__)).scalar()
+        self.counts[root] = 0
+        self.written = dict(self.counts)
+        self.written[root] = 1
+        self.root_written = True
+        if 'documents' in metadata:
+            self.documents = metadata['documents']
+        for model, column_names in self.get_indexes():
+            self.create_index(model, column_names)
         self.session.commit()
     
     def size(self, table):
         return self.counts[table]
     
+    def truncate(self, sizes):
+        for table, size in sizes.items():
+            cache = self.cache[table]
+            first = self.counts[table] - len(cache)  # _id of the first cached row
+            if size < first:
+                # Some of them were already flushed
+                model = self.model_classes[table]
+                self.session.connection().execute(model.__table__.delete().where(model._id >= size))
+                self.written[table] = size
+            keep = max(size - first, 0)
+            self.cached -= len(cache) - keep
+            del cache[keep:]
+            self.counts[table] = size
+    
     def __iter__(self):
         all_symbols = reduce(set.union, self.symbol_directory.values())
         return self.query([sym for sym in all_symbols if not isinstance(sym, InternalSymbol)])
@@ -173,98 +521,723 @@ class SQLIntermediate(Intermediate):
                 relevant_tables_used.add(t)
         return relevant_tables
     
-    def query(self, symbols=everything, known_values={}):
-        if symbols is everything:
-            symbols = [S(symbol_name) for symbol_name in self.canonicalizer]
+    def build_statement(self, symbols, known_symbols, null_symbols):
+        # Symbols used as known values are filtered on, so they're worth an index from now on
+        for sym in list(known_symbols) + list(null_symbols):
+            self.create_index(self.canonicalizer[sym.s][0], (sym.s,))
         
-        known_value_constraints = [(self.canonicalizer.get_canonical_column(sym) == val) for sym, val in known_values.items()]
+        # Known values are bound parameters, so the statement can be reused for any values
+        params = {sym: 'known_%d' % i for i, sym in enumerate(known_symbols)}
+        known_value_constraints = [(self.canonicalizer.get_canonical_column(sym) == bindparam(params[sym])) for sym in known_symbols]
+        known_value_constraints += [self.canonicalizer.get_canonical_column(sym).is_(None) for sym in null_symbols]
         query_cols = [self.canonicalizer.get_canonical_column(sym) for sym in symbols]
         
         # one hacky but important query optimization: identify all variables with tree-violating contraints,
         # and include them in all queries. Other than that, only include contraints needed for tree.
-        relevant_symbols = list(set(symbols + list(known_values.keys()) + self.repeated_symbols))
+        relevant_symbols = list(set(list(symbols) + list(known_symbols) + list(null_symbols) + self.repeated_symbols))
         relevant_tables = self.get_relevant_tables(relevant_symbols)
         
-        #print(self.show())
-        
-        # TODO: clean up query construction and related cruft
-        query = self.session.query(self.model_classes[root], *query_cols)
+        root_model = self.model_classes[root]
+        if len(symbols) == 0:
+            # Just check that a solution exists
+            statement = select(root_model._id).select_from(root_model)
+        else:
+            statement = select(*query_cols).select_from(root_model)
         for table in relevant_tables:
-            query = query.join(self.model_classes[table],
-                               self.model_classes[table]._parent_id == self.model_classes[self.parents[table]]._id)
-        query = query.\
-            filter(*known_value_constraints).\
-            filter(*self.non_tree_constraints).\
-            distinct()
-        #print(str(query))
-        for result in query.all():
+            statement = statement.join(self.model_classes[table],
+                                       self.model_classes[table]._parent_id == self.model_classes[self.parents[table]]._id)
+        statement = statement.\
+            where(*known_value_constraints).\
+            where(*self.non_tree_constraints)
+        if len(symbols) == 0:
+            statement = statement.limit(1)
+        else:
+            # Distinct solutions, each in order of the first rows it came from, so results come out in
+            # data order and the same with or without known values (see substitute_grouped())
+            order = [func.min(self.model_classes[table]._id) for table in relevant_tables]
+            statement = statement.group_by(*query_cols).order_by(*order)
+        return statement, params
+    
+    def get_statement(self, symbols, known_values):
+        # LRU cache of statements, keyed by everything that determines the statement except the values themselves
+        null_symbols = frozenset(sym for sym, val in known_values.items() if val is None)
+        known_symbols = frozenset(known_values) - null_symbols
+        key = (tuple(symbols), known_symbols, null_symbols)
+        if key in self.statement_cache:
+            self.statement_cache.move_to_end(key)
+            self.statement_cache_hits += 1
+            statement, params = self.statement_cache[key]
+        else:
+            self.statement_cache_misses += 1
+            statement, params = self.build_statement(symbols, known_symbols, null_symbols)
+            self.statement_cache[key] = (statement, params)
+            if len(self.statement_cache) > self.statement_cache_size:
+                self.statement_cache.popitem(last=False)
+        return statement, {params[sym]: known_values[sym] for sym in known_symbols}
+    
+    def explain(self, statement, params):
+        # The db's plan for a query, as a list of rows of strings
+        compiled = statement.compile(dialect=self.engine.dialect)
+        params = compiled.construct_params(params)
+        if compiled.positional:
+            params = tuple(params[name] for name in compiled.positiontup)
+        prefix = 'EXPLAIN QUERY PLAN ' if self.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+        rows = self.session.connection().exec_driver_sql(prefix + str(compiled), params).all()
+        return [' '.join(str(value) for value in row) for row in rows]
+    
+    def query_cache_info(self):
+        return {'hits': self.statement_cache_hits, 'misses': self.statement_cache_misses,
+                'size': len(self.statement_cache), 'maxsize': self.statement_cache_size}
+    
+    def query(self, symbols=everything, known_values={}):
+        if symbols is everything:
+            symbols = [S(symbol_name) for symbol_name in self.canonicalizer]
+        
+        statement, params = self.get_statement(symbols, known_values)
+        start = time.perf_counter()
+        results = self.session.connection().execute(statement, params).all()
+        for observer in self.observers:
+            observer.on_query(self, statement, params, time.perf_counter() - start, len(results))
+        for result in results:
             if len(symbols) == 0:
                 # check that a solution exists, then yield empty.
-                # needs a special case because result is just the root object in this case, rather than a tuple with root as first element
                 yield {}
                 return
-            yield {sym: res for sym, res in zip(symbols, result[1:])}
+            yield {sym: res for sym, res in zip(symbols, result)}
         return
 
+class Untyped(UserDefinedType):
+    # Column with no type affinity in sqlite, so each value keeps its own storage class (INTEGER, REAL, TEXT, BLOB)
+    cache_ok = True
+    
+    def get_col_spec(self, **kw):
+        return 'BLOB'
+
+unhashable = object()  # Marks keys made by freeze(), so they can't equal any real value
+
+def freeze(value):
+    # Hashable key for value, equal for equal values, e.g. for dicts and lists. Raises TypeError if there isn't one.
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        pass
+    if isinstance(value, dict):
+        return (unhashable, type(value), frozenset((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (unhashable, type(value), tuple(freeze(v) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return (unhashable, type(value), frozenset(freeze(v) for v in value))
+    if isinstance(value, bytearray):
+        return (unhashable, type(value), bytes(value))
+    raise TypeError('No hashable key for: ' + repr(value))
+
+def value_key(value):
+    try:
+        return freeze(value)
+    except TypeError:
+        # Only equal to itself. The decoder keeps value alive, so the id stays valid.
+        return (unhashable, id, id(value))
+
 class MemoryIntermediate(SQLIntermediate):
-    # Uses an in-memory sqlite db and assigns id's to store in db, so non-serializable objects can be used in data
-    # NOTE: data for any repeated symbols must be hashable
-    def __init__(self, types={}):
+    # Uses an in-memory sqlite db. ints, floats and strs are stored as-is, so sqlite can compare and index
+    # them natively. bools are stored as 0/1, so they equal ints just like in python; they come back as
+    # bools unless the same symbol also holds ints. Anything else (None, dicts, arbitrary objects...) is
+    # stored as a bytes id into a per-symbol decoder, so non-serializable objects can be used in data.
+    def __init__(self, types={}, engine=None, flush_threshold=10000, statement_cache_size=128, index_symbols=(),
+                 prune=False):
         self.direct_types = types
-        self.decoder = []
-        self.encoder = {0:0}
-        super().__init__(types=types)
+        self.encoders = {}  # symbol -> {value key: bytes id}
+        self.decoders = {}  # symbol -> [value]
+        self.bools = set()  # Symbols holding bools, and ints, see decode()
+        self.ints = set()
+        super().__init__(types=types, engine=engine, flush_threshold=flush_threshold,
+                         statement_cache_size=statement_cache_size, index_symbols=index_symbols, prune=prune)
     
-    def build(self, lhs):
-        self.symbol_directory = get_symbol_directory(lhs)
-        all_symbols = reduce(set.union, self.symbol_directory.values(), set())
-        # TODO: interaction between this and base class build is confusing
-        self.types = {s:self.direct_types.get(s, Integer) for s in all_symbols}
-        super().build(lhs)
+    def setup(self, symbol_directory, parents):
+        all_symbols = reduce(set.union, symbol_directory.values(), set())
+        self.types = {s:self.direct_types.get(s, Untyped) for s in all_symbols}
+        super().setup(symbol_directory, parents)
+    
+    def get_metadata(self):
+        metadata = super().get_metadata()
+        metadata['types'] = self.direct_types
+        metadata['bools'] = self.bools
+        metadata['ints'] = self.ints
+        return metadata
+    
+    def save_metadata(self, connection):
+        # The decoders have to go too, or the ids in the db are meaningless
+        super().save_metadata(connection)
+        connection.execute('DROP TABLE IF EXISTS _algex_values')
+        connection.execute('CREATE TABLE _algex_values (symbol TEXT, _id INTEGER, value BLOB, PRIMARY KEY (symbol, _id))')
+        connection.executemany('INSERT INTO _algex_values VALUES (?, ?, ?)',
+                               [(symbol.s, i, pickle.dumps(value)) for symbol, decoder in self.decoders.items()
+                                for i, value in enumerate(decoder)])
+    
+    def reset(self):
+        super().reset()
+        self.encoders = {}
+        self.decoders = {}
+        self.bools = set()
+        self.ints = set()
+    
+    def restore(self, metadata):
+        super().restore(metadata)
+        self.bools = metadata.get('bools', set())
+        self.ints = metadata.get('ints', set())
+        rows = self.session.connection().exec_driver_sql('SELECT symbol, value FROM _algex_values ORDER BY symbol, _id')
+        for name, value in rows:
+            # Straight into the decoders, in _id order, rather than through encode()
+            value = pickle.loads(value)
+            decoder = self.decoders.setdefault(S(name), [])
+            self.encoders.setdefault(S(name), {})[value_key(value)] = b'%d' % len(decoder)
+            decoder.append(value)
     
     def encode(self, symbol, value):
-        if symbol in self.direct_types:
+        tp = type(value)
+        if tp is str or (tp is float and value == value):
+            return value  # sqlite stores these natively (NaN would become NULL)
+        if tp is int and -1 << 63 <= value < 1 << 63:
+            self.ints.add(symbol)
+            return value
+        if symbol in self.direct_types or isinstance(symbol, InternalSymbol):
             return value
-        if isinstance(symbol, InternalSymbol):
-            return value + 1 # NOTE: for some reason autoincrement is starting at 1?
-        if value in self.encoder:
-            return self.encoder[value]
+        if tp is bool:
+            self.bools.add(symbol)
+            return int(value)
         
-        self.encoder[value] = len(self.decoder)
-        self.decoder.append(value)
-        return len(self.decoder) - 1
+        encoder = self.encoders.setdefault(symbol, {})
+        key = value_key(value)
+        if key not in encoder:
+            decoder = self.decoders.setdefault(symbol, [])
+            encoder[key] = b'%d' % len(decoder)
+            decoder.append(value)
+        return encoder[key]
     
     def decode(self, symbol, value):
-        if symbol in self.direct_types:
+        tp = type(value)
+        if tp is int and symbol in self.bools and symbol not in self.ints:
+            return bool(value)
+        if tp is not bytes or symbol in self.direct_types:
             return value
-        if isinstance(symbol, InternalSymbol):
-            return value - 1
-        return self.decoder[value]
+        return self.decoders[symbol][int(value)]
     
-    def append(self, table, row):
-        encoded_row = {k: self.encode(k, v) for k, v in row.items()}
-        super().append(table, encoded_row)
+    def make_row(self, table, row):
+        encode = self.encode
+        return (self.counts[table],) + tuple(encode(sym, row[sym]) if sym in row else None for sym in self.columns[table])
     
     def query(self, symbols=everything, known_values={}):
         known_values = {sym: self.encode(sym, val) for sym, val in known_values.items()}
+        decode = self.decode
         for encoded_result in super().query(symbols=symbols, known_values=known_values):
-            yield {sym: self.decode(sym, res) for sym, res in encoded_result.items()}
+            yield {sym: decode(sym, res) for sym, res in encoded_result.items()}
         return
 
+class PythonIntermediate(Intermediate):
+    # Keeps rows in python lists and answers queries with hash joins, so no sqlite db or ORM
+    # classes need to be set up. Setup cost is negligible, which makes this the better choice
+    # for small inputs; big-O behavior of queries is roughly the same as MemoryIntermediate.
+    def build(self, lhs):
+        self.template_info = template_info(lhs)
+        self.symbol_directory = self.template_info.symbol_directory
+        self.parents = self.template_info.parents
+        
+        self.reverse_symbol_directory = {} # list tables containing each symbol
+        for table_sym in self.symbol_directory:
+            if table_sym == root:
+                continue  # root never holds rows, same as SQLIntermediate
+            for sym in self.symbol_directory[table_sym]:
+                self.reverse_symbol_directory.setdefault(sym, []).append(table_sym)
+        self.repeated_symbols = [sym for sym, tables in self.reverse_symbol_directory.items() if len(tables) > 1]
+        
+        # Parents before children, in template order, so query results come out in data order
+        self.table_order = get_table_order(self.parents)
+        
+        # Rows are tuples, (_parent_id, *symbols), rather than dicts, to keep them small
+        self.symbols = {table: list(self.symbol_directory[table]) for table in self.parents}
+        self.positions = {table: {sym: i + 1 for i, sym in enumerate(symbols)} for table, symbols in self.symbols.items()}
+        # Root has no rows of its own; the single root row has _id 0, same as size(root)
+        self.rows = {table: [] for table in self.parents}
+        self.rows[root] = []
+        self.children = {}  # table -> {parent _id: [child _ids]}, built lazily
+        self.value_index = {}  # (table, symbol) -> {(parent _id, value): [child _ids]}, built lazily
+    
+    def append(self, table, row):
+        get = row.get
+        self.rows[table].append((row[parent_id],) + tuple(get(sym) for sym in self.symbols[table]))
+    
+    def finish(self):
+        # Indexes are built lazily by query(), so nothing to do here
+        self.children = {}
+        self.value_index = {}
+    
+    def size(self, table):
+        return len(self.rows[table])
+    
+    def truncate(self, sizes):
+        for table, size in sizes.items():
+            del self.rows[table][size:]
+    
+    def __iter__(self):
+        return self.query([sym for sym in self.reverse_symbol_directory if not isinstance(sym, InternalSymbol)])
+    
+    def get_single(self):
+        return [s for s in self][0]
+    
+    def get_children(self, table):
+        if table not in self.children:
+            index = {}
+            for _id, row in enumerate(self.rows[table]):
+                index.setdefault(row[0], []).append(_id)
+            self.children[table] = index
+        return self.children[table]
+    
+    def get_value_index(self, table, symbol):
+        if (table, symbol) not in self.value_index:
+            # Keyed by value_key(), so dicts and lists can be joined on too
+            index = {}
+            i = self.positions[table][symbol]
+            for _id, row in enumerate(self.rows[table]):
+                index.setdefault((row[0], value_key(row[i])), []).append(_id)
+            self.value_index[(table, symbol)] = index
+        return self.value_index[(table, symbol)]
+    
+    def get_relevant_tables(self, relevant_symbols):
+        relevant_tables = set()
+        for sym in relevant_symbols:
+            for table_sym in self.reverse_symbol_directory[sym]:
+                while table_sym != root and table_sym not in relevant_tables:
+                    relevant_tables.add(table_sym)
+                    table_sym = self.parents[table_sym]
+        return [table for table in self.table_order if table in relevant_tables]
+    
+    def plan(self, symbols, known_values):
+        # For each table to join, figure out which symbols it binds and which it has to check.
+        # Same constraints as SQLIntermediate.query: known values apply to the first table
+        # containing the symbol, repeated symbols must be equal across all tables containing them.
+        # binds and checks are (symbol, position in row) pairs.
+        relevant_symbols = list(set(list(symbols) + list(known_values.keys()) + self.repeated_symbols))
+        steps = []
+        bound = set()
+        for table in self.get_relevant_tables(relevant_symbols):
+            binds, checks, join_on = [], [], None
+            for sym in self.symbol_directory[table]:
+                column = (sym, self.positions[table][sym])
+                if sym in bound:
+                    if join_on is None:
+                        join_on = sym  # hash join on the first already-bound symbol
+                    else:
+                        checks.append(column)
+                elif sym in known_values:
+                    checks.append(column)
+                    bound.add(sym)
+                elif sym in relevant_symbols:
+                    binds.append(column)
+                    bound.add(sym)
+            steps.append((table, self.parents[table], binds, checks, join_on))
+        return steps
+    
+    def query(self, symbols=everything, known_values={}):
+        if symbols is everything:
+            symbols = list(self.reverse_symbol_directory)
+        steps = self.plan(symbols, known_values)
+        
+        values = dict(known_values)  # symbol -> value in the current partial solution
+        row_ids = {root: 0}  # table -> _id in the current partial solution
+        
+        def join(step_index):
+            if step_index == len(steps):
+                yield tuple(values[sym] for sym in symbols)
+                return
+            table, parent, binds, checks, join_on = steps[step_index]
+            rows = self.rows[table]
+            if join_on is None:
+                candidates = self.get_children(table).get(row_ids[parent], ())
+            else:
+                candidates = self.get_value_index(table, join_on).get((row_ids[parent], value_key(values[join_on])), ())
+            for _id in candidates:
+                row = rows[_id]
+                if any(row[i] != values[sym] for sym, i in checks):
+                    continue
+                for sym, i in binds:
+                    values[sym] = row[i]
+                row_ids[table] = _id
+                yield from join(step_index + 1)
+        
+        if len(symbols) == 0:
+            # check that a solution exists, then yield empty.
+            for result in join(0):
+                yield {}
+                return
+            return
+        
+        seen, seen_unhashable = set(), []
+        for result in join(0):
+            try:
+                if result in seen:
+                    continue
+                seen.add(result)
+            except TypeError:
+                if result in seen_unhashable:
+                    continue
+                seen_unhashable.append(result)
+            yield {sym: res for sym, res in zip(symbols, result)}
+        return
+
+class NumpyIntermediate(Intermediate):
+    # Stores each table as numpy arrays of integer codes (values are dictionary-encoded, same as
+    # MemoryIntermediate) and answers queries with vectorized joins, no SQL involved.
+    # Rows are buffered python-side and turned into arrays chunk_size rows at a time.
+    # Codes are per symbol and keyed by type too, so 1, 1.0 and True come back as they went in. Each code
+    # also has a class, shared by all equal values (by value_key()), and that's what joins compare.
+    def __init__(self, chunk_size=4096):
+        self.chunk_size = chunk_size
+    
+    def build(self, lhs):
+        import numpy  # Not a hard requirement of algex, so fail here rather than on import
+        self.template_info = template_info(lhs)
+        self.symbol_directory = self.template_info.symbol_directory
+        self.parents = self.template_info.parents
+        
+        self.reverse_symbol_directory = {} # list tables containing each symbol
+        for table_sym in self.symbol_directory:
+            if table_sym == root:
+                continue  # root never holds rows, same as SQLIntermediate
+            for sym in self.symbol_directory[table_sym]:
+                self.reverse_symbol_directory.setdefault(sym, []).append(table_sym)
+        self.repeated_symbols = [sym for sym, tables in self.reverse_symbol_directory.items() if len(tables) > 1]
+        self.table_order = get_table_order(self.parents)
+        
+        # Columns of each table, after _parent_id
+        self.symbols = {table: list(self.symbol_directory[table]) for table in self.parents}
+        self.buffers = {table: [] for table in self.parents}
+        self.chunks = {table: [] for table in self.parents}
+        self.counts = {table: 0 for table in self.parents}
+        self.counts[root] = 0
+        self.arrays = {}  # table -> {symbol: column of codes}, see finish()
+        self.child_index = {}  # table -> (argsort of _parent_id, sorted _parent_id), built lazily
+        
+        # Per symbol, code 0 is always None
+        all_symbols = set(sym for table in self.parents for sym in self.symbols[table])
+        self.encoders = {sym: {(type(None), None): 0} for sym in all_symbols}  # symbol -> {(type, value key): code}
+        self.decoders = {sym: [None] for sym in all_symbols}  # symbol -> [value]
+        self.class_ids = {sym: {None: 0} for sym in all_symbols}  # symbol -> {value key: class}
+        self.classes = {sym: [0] for sym in all_symbols}  # symbol -> [class of each code]
+        self.decoder_arrays = {}
+        self.class_arrays = {}
+    
+    def encode(self, symbol, value):
+        key = value_key(value)
+        encoder = self.encoders[symbol]
+        code = encoder.get((type(value), key))
+        if code is None:
+            decoder = self.decoders[symbol]
+            code = encoder[(type(value), key)] = len(decoder)
+            decoder.append(value)
+            class_ids = self.class_ids[symbol]
+            self.classes[symbol].append(class_ids.setdefault(key, len(class_ids)))
+        return code
+    
+    def append(self, table, row):
+        encode = self.encode
+        get = row.get
+        buffer = self.buffers[table]
+        buffer.append((row[parent_id],) + tuple(encode(sym, get(sym)) for sym in self.symbols[table]))
+        self.counts[table] += 1
+        if len(buffer) >= self.chunk_size:
+            self.flush(table)
+    
+    def flush(self, table):
+        import numpy as np
+        buffer = self.buffers[table]
+        if buffer:
+            self.chunks[table].append(np.array(buffer, dtype=np.int64).reshape(len(buffer), len(self.symbols[table]) + 1))
+            self.buffers[table] = []
+    
+    def finish(self):
+        import numpy as np
+        for table in self.parents:
+            self.flush(table)
+            chunks = self.chunks[table]
+            rows = np.concatenate(chunks) if chunks else np.zeros((0, len(self.symbols[table]) + 1), dtype=np.int64)
+            self.chunks[table] = [rows]  # So extend() + finish() again only has to add the new rows
+            # Column-major, so each column is contiguous
+            columns = np.ascontiguousarray(rows.T)
+            self.arrays[table] = dict(zip([parent_id] + self.symbols[table], columns))
+        self.child_index = {}
+        self.decoder_arrays = {}
+        self.class_arrays = {}
+    
+    def size(self, table):
+        return self.counts[table]
+    
+    def truncate(self, sizes):
+        for table, size in sizes.items():
+            extra = self.counts[table] - size
+            buffer, chunks = self.buffers[table], self.chunks[table]
+            while extra > len(buffer):
+                # Rows already moved into chunks
+                extra -= len(buffer)
+                buffer = [tuple(row) for row in chunks.pop().tolist()]
+            del buffer[len(buffer) - extra:]
+            self.buffers[table] = buffer
+            self.counts[table] = size
+    
+    def __iter__(self):
+        return self.query([sym for sym in self.reverse_symbol_directory if not isinstance(sym, InternalSymbol)])
+    
+    def get_single(self):
+        return [s for s in self][0]
+    
+    def get_child_index(self, table):
+        import numpy as np
+        if table not in self.child_index:
+            parent_ids = self.arrays[table][parent_id]
+            order = np.argsort(parent_ids, kind='stable')  # Usually sorted already
+            self.child_index[table] = (order, parent_ids[order])
+        return self.child_index[table]
+    
+    def get_decoder_array(self, symbol):
+        import numpy as np
+        decoder = self.decoders[symbol]
+        if len(self.decoder_arrays.get(symbol, ())) != len(decoder):
+            self.decoder_arrays[symbol] = np.fromiter(decoder, dtype=object, count=len(decoder))
+        return self.decoder_arrays[symbol]
+    
+    def get_class_array(self, symbol):
+        # Maps codes to classes, so codes of equal values compare equal
+        import numpy as np
+        classes = self.classes[symbol]
+        if len(self.class_arrays.get(symbol, ())) != len(classes):
+            self.class_arrays[symbol] = np.array(classes, dtype=np.int64)
+        return self.class_arrays[symbol]
+    
+    get_relevant_tables = PythonIntermediate.get_relevant_tables
+    
+    def join(self, table, frame_ids):
+        # All (partial solution, child row) pairs where the child row's parent is in the partial solution.
+        # Returns the index into the current partial solutions, and the child _id, for each pair.
+        import numpy as np
+        order, sorted_parents = self.get_child_index(table)
+        parent_ids = frame_ids[self.parents[table]]
+        lo = np.searchsorted(sorted_parents, parent_ids, 'left')
+        counts = np.searchsorted(sorted_parents, parent_ids, 'right') - lo
+        frame = np.repeat(np.arange(len(parent_ids)), counts)
+        # Positions lo[i], lo[i]+1, ..., hi[i]-1 for each partial solution i, all in one array
+        offsets = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        return frame, order[np.arange(len(frame)) + offsets]
+    
+    def query(self, symbols=everything, known_values={}):
+        import numpy as np
+        if symbols is everything:
+            symbols = list(self.reverse_symbol_directory)
+        known = {}  # symbol -> class
+        for sym, value in known_values.items():
+            if sym not in self.class_ids:
+                continue  # Not in any table, same as SQLIntermediate
+            known[sym] = self.class_ids[sym].get(value_key(value))
+            if known[sym] is None:
+                return  # Value never seen, so there are no solutions
+        
+        # Same constraints as SQLIntermediate.query: known values apply to every table containing
+        # the symbol, repeated symbols must be equal across all tables containing them.
+        relevant_symbols = set(symbols) | set(known) | set(self.repeated_symbols)
+        frame_ids = {root: np.zeros(1, dtype=np.int64)}  # table -> _id in each partial solution
+        values = {}  # symbol -> code in each partial solution
+        for table in self.get_relevant_tables(relevant_symbols):
+            columns = self.arrays[table]
+            frame, rows = self.join(table, frame_ids)
+            mask = None
+            for sym in self.symbol_directory[table]:
+                if sym in known:
+                    matches = self.get_class_array(sym)[columns[sym][rows]] == known[sym]
+                elif sym in values:
+                    classes = self.get_class_array(sym)
+                    matches = classes[columns[sym][rows]] == classes[values[sym][frame]]
+                else:
+                    continue
+                mask = matches if mask is None else mask & matches
+            if mask is not None:
+                frame, rows = frame[mask], rows[mask]
+            
+            frame_ids = {t: ids[frame] for t, ids in frame_ids.items()}
+            values = {sym: codes[frame] for sym, codes in values.items()}
+            frame_ids[table] = rows
+            for sym in self.symbol_directory[table]:
+                if sym in relevant_symbols and sym not in values and sym not in known:
+                    values[sym] = columns[sym][rows]
+            if not len(rows):
+                return
+        
+        if len(symbols) == 0:
+            # Reaching here means at least one solution exists
+            yield {}
+            return
+        
+        n = len(next(iter(frame_ids.values())))
+        unknown = [sym for sym in symbols if sym not in known]
+        if unknown:
+            classes = np.stack([self.get_class_array(sym)[values[sym]] for sym in unknown], axis=1)
+            # Distinct solutions (by class, so 1 and 1.0 are the same solution), in the order they first appear
+            first = np.sort(np.unique(classes, axis=0, return_index=True)[1])
+        else:
+            first = np.zeros(1, dtype=np.int64)
+        columns = [[known_values[sym]] * len(first) if sym in known else
+                   self.get_decoder_array(sym)[values[sym][first]].tolist() for sym in symbols]
+        for result in zip(*columns):
+            yield dict(zip(symbols, result))
+        return
+
+def is_small(data, limit=1000):
+    # Count nodes of the data, giving up as soon as we pass the limit.
+    # Anything we can't look inside without consuming it (streams etc) counts as big.
+    stack = [data]
+    count = 0
+    while stack:
+        item = stack.pop()
+        count += 1
+        if count > limit:
+            return False
+        if isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+        elif hasattr(item, '__next__'):
+            return False
+    return True
+
+def default_intermediate(data):
+    # sqlite setup costs far more than solving a small document, so skip it when we can
+    if is_small(data):
+        return PythonIntermediate()
+    return MemoryIntermediate()
+
+def id_column(table):
+    # Column holding each table's _id in PandasIntermediate's joined frames
+    return '_id:' + table.s
+
 class PandasIntermediate(Intermediate):
-    # Mainly useful for testing the solver.
+    # Keeps each table as a pandas DataFrame (in self.solutions, indexed by _id, with a _parent_id
+    # column and one object column per symbol) and answers queries with merges.
+    # Rows are buffered while solving, and each DataFrame is built once in finish().
     def build(self, lhs):
-        import pandas as pd  # Huge library, don't want to require it
-        parents = get_tree_structure(lhs)
-        self.solutions = {table: pd.DataFrame() for table in parents}
-        self.solutions[root] = pd.DataFrame()
+        import pandas  # Huge library, don't want to require it, so fail here rather than on import
+        self.template_info = template_info(lhs)
+        self.symbol_directory = self.template_info.symbol_directory
+        self.parents = self.template_info.parents
+        
+        self.reverse_symbol_directory = {} # list tables containing each symbol
+        for table_sym in self.symbol_directory:
+            if table_sym == root:
+                continue  # root never holds rows, same as SQLIntermediate
+            for sym in self.symbol_directory[table_sym]:
+                self.reverse_symbol_directory.setdefault(sym, []).append(table_sym)
+        self.repeated_symbols = [sym for sym, tables in self.reverse_symbol_directory.items() if len(tables) > 1]
+        self.table_order = get_table_order(self.parents)
+        
+        self.symbols = {table: list(self.symbol_directory[table]) for table in self.parents}
+        self.buffers = {table: [] for table in self.parents}
+        self.counts = {table: 0 for table in self.parents}
+        self.counts[root] = 0
+        self.solutions = {}
     
     def append(self, table, row):
-        self.solutions[table] = self.solutions[table].append(row, ignore_index=True)
+        get = row.get
+        self.buffers[table].append((row[parent_id],) + tuple(get(sym) for sym in self.symbols[table]))
+        self.counts[table] += 1
     
     def finish(self):
-        # Outermost elements need a parent to point to, so we use a singleton self-pointer
-        self.solutions[root] = self.solutions[root].append({root: 0}, ignore_index=True)
+        import pandas as pd
+        for table in self.parents:
+            # object columns, so values come back exactly as they went in (no None -> NaN, int -> float)
+            frame = pd.DataFrame(self.buffers[table], columns=['_parent_id'] + [sym.s for sym in self.symbols[table]], dtype=object)
+            frame['_parent_id'] = frame['_parent_id'].astype('int64')
+            # After extend(), the new rows go after the ones already in the frame
+            frame.index = pd.RangeIndex(self.counts[table] - len(frame), self.counts[table], name='_id')
+            if table in self.solutions and len(self.solutions[table]):
+                frame = pd.concat([self.solutions[table], frame])
+            self.solutions[table] = frame
+            self.buffers[table] = []
     
     def size(self, table):
-        return len(self.solutions[table])
+        return self.counts[table]
+    
+    def truncate(self, sizes):
+        for table, size in sizes.items():
+            buffer = self.buffers[table]
+            del buffer[len(buffer) - (self.counts[table] - size):]
+            self.counts[table] = size
+    
+    def __iter__(self):
+        return self.query([sym for sym in self.reverse_symbol_directory if not isinstance(sym, InternalSymbol)])
+    
+    def get_single(self):
+        return [s for s in self][0]
+    
+    get_relevant_tables = PythonIntermediate.get_relevant_tables
+    
+    def query_frame(self, symbols=everything, known_values={}):
+        '''Like query(), but returns the distinct solutions as a DataFrame with one column per symbol.'''
+        import pandas as pd
+        if symbols is everything:
+            symbols = list(self.reverse_symbol_directory)
+        
+        # Same constraints as SQLIntermediate.query: known values apply to every table containing
+        # the symbol, repeated symbols must be equal across all tables containing them.
+        relevant_symbols = set(symbols) | set(known_values) | set(self.repeated_symbols)
+        frame = pd.DataFrame({id_column(root): [0]})
+        bound = set()
+        for table in self.get_relevant_tables(relevant_symbols):
+            rows = self.solutions[table]
+            for sym, value in known_values.items():
+                if sym in self.symbol_directory[table]:
+                    rows = rows[equals(rows[sym.s], value)]
+            keep = [sym for sym in self.symbols[table] if sym in relevant_symbols]
+            join_on = [sym.s for sym in keep if sym in bound]  # Repeated symbols
+            rows = rows[['_parent_id'] + [sym.s for sym in keep]].reset_index()
+            rows = rows.rename(columns={'_id': id_column(table)})
+            try:
+                frame = frame.merge(rows, left_on=[id_column(self.parents[table])] + join_on,
+                                    right_on=['_parent_id'] + join_on).drop(columns='_parent_id')
+            except TypeError:
+                # Unhashable values (dicts, lists...) in a repeated symbol: join on hashable keys for them instead
+                keys = ['key:' + name for name in join_on]
+                for name, key in zip(join_on, keys):
+                    frame[key] = frame[name].map(value_key)
+                    rows[key] = rows[name].map(value_key)
+                frame = frame.merge(rows.drop(columns=join_on), left_on=[id_column(self.parents[table])] + keys,
+                                    right_on=['_parent_id'] + keys).drop(columns=['_parent_id'] + keys)
+            bound.update(keep)
+        
+        result = frame[[sym.s for sym in symbols]]
+        try:
+            result = result.drop_duplicates()
+        except TypeError:
+            # Unhashable values, do it the slow way
+            seen = []
+            first = [i for i, values in enumerate(result.itertuples(index=False, name=None))
+                     if values not in seen and not seen.append(values)]
+            result = result.iloc[first]
+        return result.reset_index(drop=True)
+    
+    def query(self, symbols=everything, known_values={}):
+        if symbols is everything:
+            symbols = list(self.reverse_symbol_directory)
+        frame = self.query_frame(symbols, known_values)
+        if len(symbols) == 0:
+            # check that a solution exists, then yield empty.
+            if len(frame):
+                yield {}
+            return
+        for result in frame.itertuples(index=False, name=None):
+            yield dict(zip(symbols, result))
+        return
+
+def equals(column, value):
+    # Elementwise column == value, for an object column and any value
+    if value is None:
+        return column.isna().to_numpy()
+    if isinstance(value, (str, int, float)):
+        return (column == value).to_numpy()
+    return [v == value for v in column]
@@ -1,9 +1,14 @@
+import hashlib
+
 from .symbol import InternalSymbol
 root = InternalSymbol('root')
+parent_id = InternalSymbol('_parent_id')  # Which row of the parent table a row is under
+doc_id = InternalSymbol('_doc_id')  # Which document a row came from, see solve_many()
 
 class NoMatchException(Exception):
     pass
 
-def table_name(obj):
-    return InternalSymbol('T' + str(id(obj)))
-    #return 'T' + str(obj.__hash__())
\ No newline at end of file
+def table_name(path):
+    # Tables are named after their path (list indices and dict keys) from the top of the template.
+    # hashlib rather than hash(), since str hashes are randomized per process.
+    return InternalSymbol('T' + hashlib.sha1(repr(path).encode()).hexdigest()[:16])
\ No newline at end of file
@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from .substitute import substitute
+from .compiler import compile, CompiledTemplate
+from .intermediate import PythonIntermediate, MemoryIntermediate
+from .misc import root, parent_id, NoMatchException
+
+def solve_concurrently(template, docs, output_template=None, max_workers=None):
+    '''Solve template against each of docs on a thread pool, each document with its own intermediate.
+    Yields one result per document, in the same order as docs: the intermediate, or if
+    output_template is given, the list of substitute(output_template, ...) results, which are then
+    computed on the pool as well.'''
+    from . import solve  # Avoid circular import
+
+    if not isinstance(template, CompiledTemplate):
+        template = compile(template)  # Walk the template once, rather than once per document
+    def work(doc):
+        solutions = solve(template, doc)
+        if output_template is None:
+            return solutions
+        return list(substitute(output_template, solutions))
+
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)  # Same default as ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Keep a bounded number of documents in flight, so docs can be a stream
+        docs = iter(docs)
+        window = max_workers * 2
+        futures = deque(executor.submit(work, doc) for doc in islice(docs, window))
+        while futures:
+            result = futures.popleft().result()
+            for doc in islice(docs, 1):
+                futures.append(executor.submit(work, doc))
+            yield result
+
+# Template for solve_shard(), set once in each worker process
+shard_template = None
+
+def set_shard_template(template):
+    global shard_template
+    shard_template = template
+
+def solve_shard(shard):
+    # Solve part of the top-level list, and send the rows back as plain tuples.
+    # _parent_id's are only valid within the shard; solve_parallel() offsets them when merging.
+    intermediate = PythonIntermediate()
+    try:
+        shard_template(shard, intermediate)
+    except NoMatchException:
+        pass  # Some other shard may have matches; solve_parallel() checks once everything is merged
+    shard = {}
+    for table, columns in shard_columns(intermediate).items():
+        positions = [0] + [intermediate.positions[table][sym] for sym in columns[1:]]
+        shard[table] = [tuple(row[i] for i in positions) for row in intermediate.rows[table]]
+    return shard
+
+def shard_columns(intermediate):
+    return {table: [parent_id] + sorted(intermediate.symbol_directory[table], key=lambda sym: sym.s)
+            for table in intermediate.table_order}
+
+def solve_parallel(template, data, processes=None, chunk_size=10000, intermediate=None):
+    '''Solve template against data, splitting the top-level list of data into chunks which are solved
+    on a multiprocessing pool. Rows from each chunk are merged into a single intermediate, so the
+    result can be queried exactly like a serial solve().
+    Workers are forked so that templates don't need to be picklable (Transforms are usually
+    lambdas); where fork isn't available, this falls back to a serial solve().'''
+    from . import solve  # Avoid circular import
+
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return solve(template, data, intermediate)
+    if isinstance(template, CompiledTemplate):
+        template = template.template[0] if template.wrapped else template.template
+    if not isinstance(template, list):
+        # Outermost level should always be wrapped in a list
+        template = [template]
+        data = [data]
+    if intermediate is None:
+        intermediate = MemoryIntermediate()
+
+    intermediate.build(template)
+    columns = shard_columns(intermediate)
+
+    data = iter(data)
+    chunks = iter(lambda: list(islice(data, chunk_size)), [])
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes, initializer=set_shard_template, initargs=(compile(template),)) as pool:
+        for shard in pool.imap(solve_shard, chunks):
+            # This shard's rows go after everything merged so far, in every table
+            offsets = {table: intermediate.size(table) for table in columns}
+            offsets[root] = 0
+            for table, rows in shard.items():
+                offset = offsets[intermediate.parents[table]]
+                for row in rows:
+                    row = dict(zip(columns[table], row))
+                    row[parent_id] += offset
+                    intermediate.append(table, row)
+
+    for lhs in template:
+        if intermediate.size(intermediate.template_info.table(root, lhs)) == 0:
+            raise NoMatchException('No match found for:', lhs)
+    intermediate.finish()
+    return intermediate
@@ -0,0 +1,85 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from .compiler import CompiledTemplate
+from .intermediate import MemoryIntermediate
+from .sqlizer import template_info
+
+class IntermediatePool:
+    '''Keeps solved-and-released SQLIntermediates around, one set per template, so repeated solves
+    against the same few templates skip building model classes, creating tables and opening a
+    session. Released intermediates are emptied with reset() rather than thrown away.
+    Templates with the same tables (same structure and symbols) share intermediates.'''
+    def __init__(self, factory=MemoryIntermediate, max_idle=8):
+        self.factory = factory
+        self.max_idle = max_idle  # Per template
+        self.idle = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.build_seconds = 0.  # Spent building fresh intermediates
+        self.reset_seconds = 0.  # Spent emptying released ones
+
+    def get_key(self, template):
+        # Same wrapping as solve()
+        if isinstance(template, CompiledTemplate):
+            template = template.template
+        elif not isinstance(template, list):
+            template = [template]
+        return template, template_info(template).schema_key
+
+    def acquire(self, template):
+        '''Get an intermediate which is already built for template, ready to pass to solve().'''
+        template, key = self.get_key(template)
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                self.hits += 1
+                return idle.pop()
+            self.misses += 1
+
+        start = time.perf_counter()
+        intermediate = self.factory()
+        intermediate.build(template)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.build_seconds += elapsed
+        return intermediate
+
+    def release(self, intermediate):
+        '''Empty intermediate and keep it for the next acquire() with the same template.
+        Anything read from it (including lazy substitute() results) must be finished with first.'''
+        start = time.perf_counter()
+        intermediate.reset()
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.reset_seconds += elapsed
+            idle = self.idle.setdefault(intermediate.schema_key, [])
+            if len(idle) < self.max_idle:
+                idle.append(intermediate)
+
+    @contextmanager
+    def solve(self, template, data):
+        '''Context manager version of solve(), using an intermediate from the pool:
+            with pool.solve(template, data) as solutions:
+                results = list(substitute(output_template, solutions))'''
+        from . import solve  # Avoid circular import
+
+        intermediate = self.acquire(template)
+        try:
+            yield solve(template, data, intermediate)
+        finally:
+            self.release(intermediate)
+
+    def stats(self):
+        '''Counts and timings so far. saved_seconds estimates the setup time avoided by reusing
+        intermediates: what the hits would have cost to build fresh, less what resetting cost.'''
+        with self.lock:
+            build_cost = self.build_seconds / self.misses if self.misses else 0.
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'build_seconds': self.build_seconds,
+                    'reset_seconds': self.reset_seconds,
+                    'saved_seconds': self.hits * build_cost - self.reset_seconds}
@@ -2,7 +2,9 @@ from .symbol import S, InternalSymbol
 from .transform import Transform
 from .error_handler import ErrorHandler
 from .tree_walk import TreeWalk
-from .misc import root, NoMatchException, table_name
+from .misc import root, parent_id, NoMatchException
+from .sqlizer import template_info
+from .instrument import timed
 
 from collections import namedtuple
 
@@ -14,22 +16,37 @@ except ModuleNotFoundError as e:
 
 # TODO: cleaner format. Rather than nesting tables, use a foreign key setup to link to conceptually "nested" tables.
 Eqn = namedtuple('Equation', ['lhs', 'rhs'])
-dispatch_cache = {}
+
+class SolveState:
+    # Everything that changes during a single solve lives here rather than on the Solver,
+    # so one Solver can be used for many solves at once (e.g. from several threads)
+    def __init__(self, intermediate, info):
+        self.intermediate = intermediate
+        self.info = info  # Table names, see sqlizer.TemplateInfo
+        self.current_table = root
+
 class Solver(TreeWalk):
-    def solve_symbol(self, eqn, solve):
+    def solve_symbol(self, eqn, solve, state):
         return {eqn.lhs: eqn.rhs}
     
-    def solve_transform(self, eqn, solve):
+    def solve_transform(self, eqn, solve, state):
         # We have f(x) = rhs, so to solve it, we solve x = inv(rhs)
         return solve(Eqn(eqn.lhs.x, eqn.lhs.inv(eqn.rhs)))
     
-    def solve_error_handler(self, eqn, solve):
+    def solve_error_handler(self, eqn, solve, state):
+        # Rows from a failed attempt are dropped before handle_error() adds its own
+        table = state.current_table
+        nested = state.info.nested[(table, id(eqn.lhs))]
+        sizes = {t: state.intermediate.size(t) for t in nested if t != root}
         try:
             return solve(Eqn(eqn.lhs.x, eqn.rhs))
         except Exception as e:
-            return eqn.lhs.handle_error(e, self.intermediate, self.current_table, eqn.rhs)
+            state.intermediate.truncate(sizes)
+            for observer in state.intermediate.observers:
+                observer.on_error_handled(state.intermediate, table, eqn.lhs, e)
+            return eqn.lhs.handle_error(e, state.intermediate, table, eqn.rhs)
     
-    def solve_dict(self, eqn, solve):
+    def solve_dict(self, eqn, solve, state):
         # NOTE: need to handle same-symbol conflicts
         # TODO: type check RHS
         solution = {}
@@ -37,38 +54,51 @@ class Solver(TreeWalk):
             solution.update(solve(Eqn(v, eqn.rhs.get(k, None))))
         return solution
     
-    def solve_list(self, eqn, solve):
+    def solve_list(self, eqn, solve, state):
         # TODO: type check RHS & handle single item
-        
-        parent_table = self.current_table
-        parent_row = self.intermediate.size(parent_table)
+        solutions = self.solve_elements(eqn, solve, state)
+        for ind, subsolutions in enumerate(solutions):
+            if not subsolutions:
+                raise NoMatchException('No match found for:', eqn.lhs[ind])
+        return {}
+    
+    def solve_elements(self, eqn, solve, state):
+        # Append a row for each match of each entry of eqn.lhs in eqn.rhs, returning the solutions for each entry
+        parent_table = state.current_table
+        parent_row = state.intermediate.size(parent_table)
         
         # Each entry of eqn.lhs is actually independent, but we only want to walk
         # eqn.rhs once (to handle streams), so we handle all the eqn.lhs entries
         # inside of the eqn.rhs loop.
         solutions = [[] for lhs in eqn.lhs]
-        for rhs in eqn.rhs:
-            for ind, lhs in enumerate(eqn.lhs):
-                self.current_table = table_name(lhs)
-                try:
-                    solution = solve(Eqn(lhs, rhs))
-                    solutions[ind].append(solution)
-                    
-                    #solution[parent_table] = parent_row
-                    solution[InternalSymbol('_parent_id')] = parent_row
-                    self.intermediate.append(self.current_table, solution)
-                    #self.tables[self.current_table] = self.tables[self.current_table].append(solution, ignore_index=True)
-                except NoMatchException:
-                    # This is the filter functionality
-                    continue
-        self.current_table = parent_table
-        
-        for ind, subsolutions in enumerate(solutions):
-            if not subsolutions:
-                raise NoMatchException('No match found for:', eqn.lhs[ind])
-        return {}
+        tables = [state.info.table(parent_table, lhs) for lhs in eqn.lhs]
+        descendants = [state.info.descendants[table] for table in tables]
+        try:
+            for rhs in eqn.rhs:
+                for ind, lhs in enumerate(eqn.lhs):
+                    state.current_table = tables[ind]
+                    # Nested lists append their rows before this one, so if it doesn't match they have to go
+                    sizes = {table: state.intermediate.size(table) for table in descendants[ind]}
+                    try:
+                        solution = solve(Eqn(lhs, rhs))
+                        solutions[ind].append(solution)
+                        
+                        #solution[parent_table] = parent_row
+                        solution[parent_id] = parent_row
+                        state.intermediate.append(tables[ind], solution)
+                        #self.tables[self.current_table] = self.tables[self.current_table].append(solution, ignore_index=True)
+                    except NoMatchException:
+                        # This is the filter functionality
+                        state.intermediate.truncate(sizes)
+                        for observer in state.intermediate.observers:
+                            observer.on_no_match(state.intermediate, tables[ind], lhs)
+                        continue
+        finally:
+            # Also on errors, which an enclosing ErrorHandler may catch and carry on from
+            state.current_table = parent_table
+        return solutions
     
-    def check_match(self, eqn, solve):
+    def check_match(self, eqn, solve, state):
         if eqn.lhs != eqn.rhs:
             raise NoMatchException('LHS does not match data:', eqn.lhs)
         return {}
@@ -81,27 +111,40 @@ class Solver(TreeWalk):
             (lambda eqn: isinstance(eqn.lhs, dict), self.solve_dict),
             (lambda eqn: isinstance(eqn.lhs, list), self.solve_list),
             (lambda eqn: True, self.check_match)])
+        self.dispatch_cache = {}
     
-    def walk(self, tree):
+    def walk(self, tree, solve, state):
         tp = type(tree.lhs)
-        if tp in dispatch_cache:
-            return dispatch_cache[tp](tree, self.walk)
+        if tp in self.dispatch_cache:
+            return self.dispatch_cache[tp](tree, solve, state)
         
         for condition, rule in self.cases.items():
             if condition(tree):
-                dispatch_cache[tp] = rule
-                return rule(tree, self.walk)
+                self.dispatch_cache[tp] = rule
+                return rule(tree, solve, state)
         return tree
     
     def __call__(self, eqn, intermediate):
-        self.intermediate = intermediate
-        intermediate.build(eqn.lhs)
-        
-        self.current_table = root
-        super().__call__(eqn)
+        state = SolveState(intermediate, template_info(eqn.lhs))
+        def solve(eqn):
+            return self.walk(eqn, solve, state)
         
-        intermediate.finish()
+        timed(intermediate, 'build', intermediate.build, eqn.lhs)
+        timed(intermediate, 'solve', solve, eqn)
+        timed(intermediate, 'finish', intermediate.finish)
         return intermediate
+    
+    def extend(self, intermediate, data):
+        # Solve more top-level elements into an already finished intermediate. Unlike a full solve,
+        # it's fine for none of them to match: the earlier data did.
+        state = SolveState(intermediate, intermediate.template_info)
+        def solve(eqn):
+            return self.walk(eqn, solve, state)
+        
+        solutions = timed(intermediate, 'solve', self.solve_elements, Eqn(state.info.template, data), solve, state)
+        timed(intermediate, 'finish', intermediate.finish)
+        return [{sym: value for sym, value in solution.items() if not isinstance(sym, InternalSymbol)}
+                for subsolutions in solutions for solution in subsolutions]
         
 solver = Solver()
     
@@ -1,10 +1,11 @@
+import threading
+from collections import OrderedDict
 from functools import reduce
 
 from .symbol import S
 from .transform import Transform
 from .error_handler import ErrorHandler
 from .misc import table_name, root
-from .tree_walk import TreeWalk
 
 # Test data
 data = [{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}], 'houses':[{'state': 'CT'}]},
@@ -17,43 +18,139 @@ def update(d1, d2):
     result.update(d2)
     return result
 
-def get_tree_structure(lhs):
-    # Map each child to its parent
+class TemplateInfo:
+    # Table structure of a template, extracted in a single walk:
+    #  - tables: (parent table, id(element)) -> name of the table for each list element
+    #  - parents: map each table to its parent
+    #  - symbol_directory: map each table to the symbols it contains
+    #  - nested: (table, id(error handler)) -> symbol directory of the error handler's subtree,
+    #    with the symbols directly inside it under root. See Nullable.
+    #  - descendants: map each table to every table nested under it
+    # Tables are named after their path from the top of the template, so names are the same
+    # in every run and every process. Same element object twice under one parent = same table.
+    def __init__(self, template):
+        self.template = template  # Keeps every element alive, so the ids in self.tables stay valid
+        self.tables = {}
+        self.children = {root: []}
+        self.symbol_directory = {}
+        self.nested = {}
+        self.symbol_directory[root] = self.walk(template, root, ())
+        
+        self.parents = {}
+        def add_children(table):
+            # Same order as the old invert-and-flatten: all children, then each child's subtree
+            self.parents.update({child: table for child in self.children[table]})
+            for child in self.children[table]:
+                add_children(child)
+        add_children(root)
+        self.descendants = {}
+        def add_descendants(table):
+            self.descendants[table] = []
+            for child in self.children[table]:
+                self.descendants[table] += [child] + add_descendants(child)
+            return self.descendants[table]
+        add_descendants(root)
+        self.schema_key = get_schema_key(self.symbol_directory, self.parents)
     
-    # We'll first extract the relevant structure as a tree, then flatten and invert
-    walker = TreeWalk([
-        (lambda lhs: isinstance(lhs, Transform), lambda tree, walk: walk(tree.x)),
-        (lambda lhs: isinstance(lhs, ErrorHandler), lambda tree, walk: walk(tree.x)),
-        (lambda lhs: isinstance(lhs, dict), lambda tree, walk: reduce(update, [walk(v) for v in tree.values()], {})),
-        (lambda lhs: isinstance(lhs, list), lambda tree, walk: {table_name(item): walk(item) for item in tree}),
-        (lambda lhs: True, lambda tree, walk: {})])
-    structure = {root: walker(lhs)}
+    def walk(self, lhs, table, path):
+        # Returns the symbols in lhs which belong to table, i.e. aren't nested in a further list
+        if isinstance(lhs, S):
+            return {lhs}
+        if isinstance(lhs, Transform):
+            return self.walk(lhs.x, table, path)
+        if isinstance(lhs, ErrorHandler):
+            if (table, id(lhs)) in self.nested:
+                return self.nested[(table, id(lhs))][root]  # Same object used twice, so same tables
+            before = set(self.symbol_directory)
+            symbols = self.walk(lhs.x, table, path)
+            nested = {t: syms for t, syms in self.symbol_directory.items() if t not in before}
+            nested[root] = symbols
+            self.nested[(table, id(lhs))] = nested
+            return symbols
+        if isinstance(lhs, dict):
+            return reduce(set.union, [self.walk(v, table, path + (k,)) for k, v in lhs.items()], set())
+        if isinstance(lhs, list):
+            for i, item in enumerate(lhs):
+                if (table, id(item)) in self.tables:
+                    continue  # Same object used twice in one table writes to a single table
+                name = table_name(path + (i,))
+                self.tables[(table, id(item))] = name
+                self.children[table].append(name)
+                self.children[name] = []
+                self.symbol_directory[name] = self.walk(item, name, path + (i,))
+            return set()
+        return set()
     
-    def invert_and_flatten(tree):
-        result = {}
-        for k, v in tree.items():
-            result.update({i: k for i in v})
-            result.update(invert_and_flatten(v))
-        return result
+    def table(self, parent, element):
+        return self.tables[(parent, id(element))]
+
+# Templates are walked once and the results memoized. Keyed by the ids of the top-level
+# elements, so a template which solve() wraps in a fresh list still hits the cache. Each entry
+# holds a reference to the elements, so an id can't be reused while it's in the cache.
+# Templates can be changed in place between solves, so hits are checked against a fingerprint.
+template_cache = OrderedDict()
+template_cache_size = 128
+template_cache_lock = threading.Lock()
+
+def fingerprint(lhs):
+    # Every node under the top-level list, plus a key made of their ids and each dict's keys. Any in-place
+    # change gives a different key, as long as the nodes are kept alive so their ids aren't reused.
+    nodes = []
+    key = []
+    stack = list(lhs)
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        key.append(id(node))
+        if isinstance(node, (Transform, ErrorHandler)):
+            stack.append(node.x)
+        elif isinstance(node, dict):
+            key.append(tuple(node))
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            key.append(len(node))
+            stack.extend(node)
+    return nodes, tuple(key)
+
+def template_info(lhs):
+    # Note: this assumes top-level is a list
+    key = tuple(map(id, lhs))
+    nodes, fingerprint_key = fingerprint(lhs)
+    with template_cache_lock:
+        info = template_cache.get(key)
+        if info is not None and info.fingerprint_key == fingerprint_key:
+            template_cache.move_to_end(key)
+            return info
     
-    return invert_and_flatten(structure)
+    info = TemplateInfo(list(lhs))
+    info.nodes, info.fingerprint_key = nodes, fingerprint_key
+    with template_cache_lock:
+        template_cache[key] = info
+        while len(template_cache) > template_cache_size:
+            template_cache.popitem(last=False)
+    return info
+
+def get_tree_structure(lhs):
+    # Map each child to its parent
+    return template_info(lhs).parents
 
 def get_symbol_directory(lhs):
     # Extract a dict mapping "tables" to the symbols they contain
-    # Note: this assumes top-level is a list
-    directory = {}
-    
-    def handle_list(tree, walk):
-        for item in tree:
-            directory[table_name(item)] = walk(item)
-        return set()
-    
-    walker = TreeWalk([
-        (lambda lhs: isinstance(lhs, S), lambda tree, walk: {tree}),
-        (lambda lhs: isinstance(lhs, Transform), lambda tree, walk: walk(tree.x)),
-        (lambda lhs: isinstance(lhs, ErrorHandler), lambda tree, walk: walk(tree.x)),
-        (lambda lhs: isinstance(lhs, dict), lambda tree, walk: reduce(set.union, map(walk, tree.values()))),
-        (lambda lhs: isinstance(lhs, list), handle_list),
-        (lambda lhs: True, lambda tree, walk: set())])
-    directory[root] = walker(lhs)
-    return directory
+    return template_info(lhs).symbol_directory
+
+def get_schema_key(symbol_directory, parents):
+    # Hashable summary of the tables a template needs. Templates with the same key can share a schema.
+    return tuple((table.s, parent.s, tuple(sorted(sym.s for sym in symbol_directory[table])))
+                 for table, parent in parents.items())
+
+def get_table_order(parents):
+    # List tables so that parents always come before their children, otherwise in template order
+    order = []
+    def add_table(table):
+        if table == root or table in order:
+            return
+        add_table(parents[table])
+        order.append(table)
+    for table in parents:
+        add_table(table)
+    return order
@@ -0,0 +1,145 @@
+import codecs
+import json
+import os
+from collections.abc import Iterator
+
+decoder = json.JSONDecoder()
+whitespace = ' \t\n\r'
+
+def is_source(data):
+    # Things solve() should read and parse, rather than treat as data. Plain strings are data.
+    return isinstance(data, os.PathLike) or hasattr(data, 'read')
+
+class JSONReader:
+    # Incremental parser for a stream containing either a JSON array, or a sequence of JSON
+    # values (e.g. JSON-lines). Yields one top-level element at a time, so memory use is
+    # bounded by the largest element rather than the whole stream.
+    # lines=None guesses from the first character; lines=True is needed for JSON-lines whose records are arrays.
+    def __init__(self, stream, chunk_size=1 << 16, lines=None):
+        self.stream = stream
+        self.lines = lines
+        self.chunk_size = chunk_size
+        self.decode = codecs.getincrementaldecoder('utf-8-sig')().decode
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self, at_least=1):
+        # Drop everything already parsed, then read at least this many more characters.
+        # Returns False if the stream was already exhausted.
+        chunks = []
+        got = 0
+        while got < at_least and not self.eof:
+            chunk = self.stream.read(self.chunk_size)
+            if isinstance(chunk, bytes):
+                chunk = self.decode(chunk, final=not chunk)
+            if not chunk:
+                self.eof = True
+            chunks.append(chunk)
+            got += len(chunk)
+        self.buffer = self.buffer[self.pos:] + ''.join(chunks)
+        self.pos = 0
+        return got > 0
+
+    def peek(self):
+        # Skip whitespace and return the next character, or '' at the end of the stream
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return ''
+
+    def value(self):
+        attempt = self.chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # A value running right up to the end of the buffer might be a truncated number
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Element is bigger than what we've read so far. Read geometrically more each time,
+            # so huge elements don't get re-parsed once per chunk.
+            self.read_more(attempt)
+            attempt *= 2
+
+    def __iter__(self):
+        if self.lines or (self.lines is None and self.peek() != '['):
+            # JSON-lines, or any other whitespace-separated sequence of JSON values
+            while self.peek():
+                yield self.value()
+            return
+
+        self.pos += 1
+        if self.peek() != ']':
+            while True:
+                yield self.value()
+                separator = self.peek()
+                if separator == ']':
+                    break
+                if separator != ',':
+                    raise ValueError('Expected "," or "]" in JSON array, got: ' + repr(separator))
+                self.pos += 1
+                self.peek()
+        self.pos += 1
+        if self.peek():
+            # Not a single array after all, and what's been yielded can't be taken back
+            raise ValueError('Unexpected data after JSON array: ' + repr(self.buffer[self.pos:self.pos + 20]) +
+                             '. For JSON-lines whose records are arrays, pass lines=True.')
+
+def iter_json(source, chunk_size=1 << 16, lines=None):
+    '''Lazily yield the top-level elements of a JSON array or JSON-lines file.
+    source can be a path (str or path-like) or a file object opened in binary or text mode.
+    A source starting with "[" is read as a single array, unless lines=True.'''
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as f:
+            yield from JSONReader(f, chunk_size, lines)
+        return
+    yield from JSONReader(source, chunk_size, lines)
+
+def write_key(key):
+    # Same key conversions as json.dumps()
+    if isinstance(key, str):
+        return key
+    if key is None or isinstance(key, (bool, int, float)):
+        return json.dumps(key)
+    raise TypeError('keys must be str, int, float, bool or None, not ' + type(key).__name__)
+
+def write_value(value, write, encode):
+    if isinstance(value, dict):
+        write('{')
+        for i, (k, v) in enumerate(value.items()):
+            if i:
+                write(', ')
+            write(encode(write_key(k)))
+            write(': ')
+            write_value(v, write, encode)
+        write('}')
+    elif isinstance(value, (list, tuple, Iterator)):
+        # Iterators (e.g. lazy results from substitute()) are consumed as they're written
+        write('[')
+        for i, item in enumerate(value):
+            if i:
+                write(', ')
+            write_value(item, write, encode)
+        write(']')
+    else:
+        write(encode(value))
+
+def write_json(obj, f, **kwargs):
+    '''Write obj to the text file f as JSON. Any iterators inside obj, including obj itself, are
+    written as arrays one item at a time, so lazy results from substitute() are never held in full.
+    kwargs are passed to json.JSONEncoder.'''
+    write_value(obj, f.write, json.JSONEncoder(**kwargs).encode)
+
+def write_jsonl(records, f, **kwargs):
+    '''Write each of records to the text file f as one line of JSON.'''
+    encode = json.JSONEncoder(**kwargs).encode
+    for record in records:
+        write_value(record, f.write, encode)
+        f.write('\n')
@@ -5,6 +5,7 @@ from .error_handler import ErrorHandler
 from .solver import solver, Eqn
 from .intermediate import PandasIntermediate, MemoryIntermediate, Intermediate
 from .sqlizer import update
+from .misc import doc_id
 
 from .tree_walk import TreeWalk
 from functools import reduce
@@ -25,55 +26,136 @@ get_outer_symbols = TreeWalk([
         (lambda tree: isinstance(tree, dict), lambda tree, walk: reduce(list.__add__, [walk(v) for v in tree.values()])),
         (lambda tree: True, lambda tree, walk: [])])
 
-dispatch_cache = {}
+# List templates directly inside this template (i.e. not nested inside another list)
+get_nested_templates = TreeWalk([
+        (lambda tree: isinstance(tree, (Transform, ErrorHandler)), lambda tree, walk: walk(tree.x)),
+        (lambda tree: isinstance(tree, dict), lambda tree, walk: reduce(list.__add__, [walk(v) for v in tree.values()], [])),
+        (lambda tree: isinstance(tree, list), lambda tree, walk: list(tree)),
+        (lambda tree: True, lambda tree, walk: [])])
+
 Substitution = namedtuple('Substitution', ['expr', 'solutions', 'known_values'])
 class Assigner(TreeWalk):
-    def __init__(self):
+    def __init__(self, lazy=False):
+        if lazy:
+            # Nested lists become iterators, and are only queried for when they're consumed
+            assign_list = lambda tree, walk: chain.from_iterable(substitute(subtree, tree.solutions, tree.known_values, lazy=True) for subtree in tree.expr)
+        else:
+            assign_list = lambda tree, walk: list(chain(*[substitute(subtree, tree.solutions, tree.known_values) for subtree in tree.expr]))
         super().__init__([
         (lambda tree: isinstance(tree.expr, S), lambda tree, walk: tree.known_values[tree.expr]),
         (lambda tree: isinstance(tree.expr, Transform), lambda tree, walk: tree.expr.f(walk(Substitution(tree.expr.x, tree.solutions, tree.known_values)))),
         (lambda tree: isinstance(tree.expr, ErrorHandler), lambda tree, walk: walk(Substitution(tree.expr.x, tree.solutions, tree.known_values))),
         (lambda tree: isinstance(tree.expr, dict), lambda tree, walk: {k: walk(Substitution(v, tree.solutions, tree.known_values)) for k, v in tree.expr.items()}),
-        # NOTE: next line is the one to change if we want results to contain iterators instead of lists.
-        (lambda tree: isinstance(tree.expr, list), lambda tree, walk: list(chain(*[substitute(subtree, tree.solutions, tree.known_values) for subtree in tree.expr]))),
+        (lambda tree: isinstance(tree.expr, list), assign_list),
         (lambda tree: True, lambda tree, walk: tree.expr)])
+        self.dispatch_cache = {}
     
     def walk(self, tree):
         tp = type(tree.expr)
-        if tp in dispatch_cache:
-            return dispatch_cache[tp](tree, self.walk)
+        if tp in self.dispatch_cache:
+            return self.dispatch_cache[tp](tree, self.walk)
         
         for condition, rule in self.cases.items():
             if condition(tree):
-                dispatch_cache[tp] = rule
+                self.dispatch_cache[tp] = rule
                 return rule(tree, self.walk)
         return tree
 assigner = Assigner()
+lazy_assigner = Assigner(lazy=True)
 
-def assign(template, solution, known_values):
+def assign(template, solution, known_values, lazy=False):
+    if lazy:
+        return lazy_assigner(Substitution(template, solution, known_values))
     return assigner(Substitution(template, solution, known_values))
 
-def substitute_list(template, solutions, known_values={}):
+def substitute_list(template, solutions, known_values={}, lazy=False):
     for soln in solutions:
-        yield assign(template, [soln], update(known_values, soln))
+        yield assign(template, [soln], update(known_values, soln), lazy)
     return
 
-def substitute_intermediate(template, intermediate, known_values={}):
+class Groups:
+    # Results of a nested list template, grouped by the values of the symbols outside of it.
+    # Values are usually hashable; anything which isn't falls back to a linear search.
+    def __init__(self):
+        self.hashed = {}
+        self.unhashable = []
+    
+    def add(self, key, result):
+        try:
+            self.hashed.setdefault(key, []).append(result)
+        except TypeError:
+            for k, results in self.unhashable:
+                if k == key:
+                    results.append(result)
+                    return
+            self.unhashable.append((key, [result]))
+    
+    def get(self, key):
+        try:
+            return self.hashed.get(key, [])
+        except TypeError:
+            for k, results in self.unhashable:
+                if k == key:
+                    return results
+            return []
+
+class GroupedSolutions:
+    # Stands in for the intermediate when assigning a single solution: nested list templates
+    # look up their prefetched results instead of querying the intermediate again
+    def __init__(self, nested, key):
+        self.nested = nested
+        self.key = key
+    
+    def get(self, template):
+        return self.nested[id(template)].get(self.key)
+
+def substitute_grouped(template, intermediate, context, known_values={}):
+    '''Yields (solution, result) pairs for template, where each solution also includes values for
+    the context symbols. Every list level of the template is fetched with a single query for all
+    solutions at once, grouped by the symbols outside of it, rather than one query per solution.
+    Intermediates return solutions in data order, so each group is in the same order a query per
+    solution would give.'''
     # Collect all symbols outside of lists (outer symbols)
-    outer_symbols = get_outer_symbols(template)
-    #outer_symbols.append(InternalSymbol('root'))  # Avoids empty queries
+    symbols = []
+    for sym in context + get_outer_symbols(template):
+        if sym not in symbols:
+            symbols.append(sym)
+    
+    # Substitute into each list-template for all values of our symbols at once
+    nested = {}
+    for subtree in get_nested_templates(template):
+        if id(subtree) in nested:
+            continue
+        groups = Groups()
+        for soln, result in substitute_grouped(subtree, intermediate, symbols, known_values):
+            groups.add(tuple(soln[sym] for sym in symbols), result)
+        nested[id(subtree)] = groups
     
     # for each value of the outer symbols...
-    for soln in intermediate.query(outer_symbols, known_values):
-        # recursively substitute into each list-template with the known values as constraints
-        yield assign(template, intermediate, update(known_values, soln))
+    for soln in intermediate.query(symbols, known_values):
+        key = tuple(soln[sym] for sym in symbols)
+        yield soln, assign(template, GroupedSolutions(nested, key), update(known_values, soln))
+    return
+
+def substitute_intermediate(template, intermediate, known_values={}):
+    for soln, result in substitute_grouped(template, intermediate, [], known_values):
+        yield result
+    return
+
+def substitute_lazy(template, intermediate, known_values={}):
+    # Nothing is prefetched: each nested list queries for its own solutions once it's consumed.
+    # More queries than substitute_grouped(), but no result is ever held in memory in full.
+    for soln in intermediate.query(get_outer_symbols(template), known_values):
+        yield assign(template, intermediate, update(known_values, soln), lazy=True)
     return
 
-def substitute(template, solution, known_values={}):
+def substitute(template, solution, known_values={}, lazy=False):
     '''solution can be:
         - a dict: will substitute that one solution into template
         - an iterable of dicts: will return an iterable, with each result corresponding to one solution
-        - an Intermediate (returned by solve()): same as iterable, but often achieves better big-O efficiency via lazy access'''
+        - an Intermediate (returned by solve()): same as iterable, but often achieves better big-O efficiency via lazy access
+    With lazy=True, lists nested inside each result are iterators rather than lists, so results can
+    be streamed out (see write_json()) without ever being built in full.'''
     
     # TODO: we currently distinct all results, so multiplicity is not supported
     # To allow multiplicity, we need to be clever about our SQL - we need multiplicity
@@ -83,10 +165,23 @@ def substitute(template, solution, known_values={}):
     # in the db.
     
     
+    if isinstance(solution, GroupedSolutions):
+        return solution.get(template)
     if isinstance(solution, Intermediate):
+        if lazy:
+            return substitute_lazy(template, solution, known_values)
         result = substitute_intermediate(template, solution, known_values)
         return result
     if isinstance(solution, dict):
-        return assign(template, solution, update(known_values, solution))
+        return assign(template, solution, update(known_values, solution), lazy)
     
-    return substitute_list(template, solution, known_values)
+    return substitute_list(template, solution, known_values, lazy)
+
+def substitute_many(template, intermediate, known_values={}):
+    '''Counterpart of solve_many(): yields one list of results per document, in the same order as
+    the documents. Documents which had no solution give an empty list.'''
+    # Same queries as a single substitute(), with doc_id as an extra grouping symbol
+    results = [[] for i in range(intermediate.documents)]
+    for soln, result in substitute_grouped(template, intermediate, [doc_id], known_values):
+        results[soln[doc_id]].append(result)
+    yield from results
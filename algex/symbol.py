@@ -1,24 +1,49 @@
+import threading
 import uuid
+import weakref
 
 class BaseSymbol:
-    pass
+    __slots__ = ()
+
+# Symbols are interned: S('x') is S('x'), so there's only ever one object per name (per class), and
+# equality checks between them are usually just an identity check. Symbols are immutable.
+interned = weakref.WeakValueDictionary()
+interned_lock = threading.Lock()
 
 class S(BaseSymbol):
-    def __init__(self, s):
-        self.s = s
-    
+    # __slots__, since every row of every solution is keyed by these
+    __slots__ = ('s', 'hash', '__weakref__')
+
+    def __new__(cls, s):
+        key = (cls, s)
+        symbol = interned.get(key)
+        if symbol is None:
+            with interned_lock:
+                symbol = interned.get(key)
+                if symbol is None:
+                    symbol = object.__new__(cls)
+                    symbol.s = s
+                    symbol.hash = hash(s)
+                    interned[key] = symbol
+        return symbol
+
     def __hash__(self):
-        return self.s.__hash__()
-    
+        return self.hash
+
     def __eq__(self, other):
-        return isinstance(other, S) and self.s == other.s
-    
+        return self is other or (isinstance(other, S) and self.s == other.s)
+
+    def __reduce__(self):
+        # Unpickled (or copied) symbols go through __new__, so they're interned too
+        return (type(self), (self.s,))
+
     def __repr__(self):
         return "S('" + self.s + "')"
 
 class InternalSymbol(S):
-    def __init__(self, s=None):
+    __slots__ = ()
+
+    def __new__(cls, s=None):
         if s is None:
-            self.s = str(uuid.uuid4())
-        else:
-            self.s = str(s)
+            s = str(uuid.uuid4())
+        return super().__new__(cls, str(s))
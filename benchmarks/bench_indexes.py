@@ -0,0 +1,45 @@
+# Compares SQLIntermediate's template-driven indexes (created after the bulk load) against
+# the old strategy of indexing every symbol column up front and never indexing _parent_id.
+# Usage: python benchmarks/bench_indexes.py [number of records]
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from algex import S, MemoryIntermediate, solver, Eqn, substitute
+
+class IndexEverything(MemoryIntermediate):
+    def get_indexes(self):
+        return [(self.model_classes[table], (sym.s,)) for table in self.table_order for sym in self.symbol_directory[table]]
+
+    def build(self, lhs):
+        super().build(lhs)
+        for model, column_names in self.get_indexes():
+            self.create_index(model, column_names)
+
+template = [{'name': S('name'), 'email': S('email'),
+             'addresses': [{'state': S('state'), 'zip': S('zip')}],
+             'houses': [{'state': S('state'), 'rooms': S('rooms')}]}]
+format_template = {'state': S('state'), 'people': [{'name': S('name'), 'zips': [S('zip')]}]}
+
+def make_data(n):
+    return [{'name': 'name%d' % i, 'email': 'user%d@example.com' % i,
+             'addresses': [{'state': 'S%d' % ((i + j) % 50), 'zip': i * 10 + j} for j in range(3)],
+             'houses': [{'state': 'S%d' % (i % 50), 'rooms': i % 7}]} for i in range(n)]
+
+def run(intermediate_class, data):
+    intermediate = intermediate_class()
+    start = time.perf_counter()
+    solver(Eqn(template, data), intermediate)
+    solved = time.perf_counter()
+    results = list(substitute(format_template, intermediate))
+    substituted = time.perf_counter()
+    for i in range(0, len(data), max(1, len(data) // 200)):
+        list(intermediate.query([S('state')], {S('name'): 'name%d' % i}))
+    queried = time.perf_counter()
+    return solved - start, substituted - solved, queried - substituted
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    data = make_data(n)
+    print('%-16s %10s %12s %14s' % ('', 'solve', 'substitute', '200 lookups'))
+    for name, intermediate_class in [('index everything', IndexEverything), ('template-driven', MemoryIntermediate)]:
+        print('%-16s %9.3fs %11.3fs %13.3fs' % ((name,) + run(intermediate_class, data)))
@@ -0,0 +1,36 @@
+# Compares SQLIntermediate's executemany() loader against loading through ORM objects.
+# Usage: python benchmarks/bench_loader.py [number of records]
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from algex import S, MemoryIntermediate, solver, Eqn
+
+class ORMIntermediate(MemoryIntermediate):
+    # The old loading path: one ORM object per row, saved with bulk_save_objects()
+    def load(self, table, rows):
+        model = self.model_classes[table]
+        column_names = ['_id'] + [sym.s for sym in self.columns[table]]
+        self.session.bulk_save_objects([model(**dict(zip(column_names, row))) for row in rows])
+
+template = [{'id': S('id'), 'name': S('name'), 'email': S('email'), 'tags': [{'tag': S('tag'), 'weight': S('weight')}]}]
+
+def make_data(n):
+    return [{'id': i, 'name': 'name%d' % i, 'email': 'user%d@example.com' % (i % 1000),
+             'tags': [{'tag': 'tag%d' % (j % 50), 'weight': j} for j in range(3)]} for i in range(n)]
+
+def time_finish(intermediate_class, data):
+    intermediate = intermediate_class(flush_threshold=None)
+    # Run the solve without finish(), then time finish() on its own
+    finish = intermediate.finish
+    intermediate.finish = lambda: None
+    solver(Eqn(template, data), intermediate)
+    start = time.perf_counter()
+    finish()
+    return time.perf_counter() - start, sum(intermediate.counts.values())
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    data = make_data(n)
+    for name, intermediate_class in [('orm', ORMIntermediate), ('executemany', MemoryIntermediate)]:
+        seconds, rows = time_finish(intermediate_class, data)
+        print('%-12s %8.3fs  %10.0f rows/s' % (name, seconds, rows / seconds))
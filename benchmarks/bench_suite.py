@@ -0,0 +1,189 @@
+# Benchmark suite: times each phase of solve/substitute on synthetic data, for each backend.
+# Results can be saved as JSON and compared against an earlier run to catch regressions.
+# Usage:
+#   python benchmarks/bench_suite.py [-n records] [--cases flat,deep] [--backends memory,python]
+#                                    [--output results.json] [--compare baseline.json]
+import argparse, json, os, platform, subprocess, sys, time, tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from algex import S, Transform, Nullable, compile, substitute, MemoryIntermediate, PythonIntermediate, NumpyIntermediate
+from algex import sqlizer
+from algex.intermediate import PandasIntermediate
+
+backends = {'memory': MemoryIntermediate,
+            'python': PythonIntermediate,
+            'numpy': NumpyIntermediate,
+            'pandas': PandasIntermediate}
+
+# Shapes of synthetic input. depth = levels of nested lists, width = items per nested list,
+# joins = extra lists sharing a repeated symbol with the top level
+cases = {'flat':       dict(depth=1),
+         'deep':       dict(depth=4, width=3),
+         'wide':       dict(depth=2, width=20),
+         'joins':      dict(depth=1, width=5, joins=2),
+         'transforms': dict(depth=2, width=3, transforms=True),
+         'nullable':   dict(depth=2, width=3, nullable=True),
+         'mixed':      dict(depth=3, width=3, joins=1, transforms=True, nullable=True)}
+
+def make_case(n, depth=1, width=3, joins=0, transforms=False, nullable=False):
+    # Returns (match template, output template, data)
+    def match_level(k):
+        value = S('value%d' % k)
+        if transforms:
+            value = Transform(value, function=str, inverse=int)  # Data holds numbers as strings
+        template = {'id': S('id%d' % k), 'value': value}
+        if k + 1 < depth:
+            children = [match_level(k + 1)]
+            template['children'] = Nullable(children) if nullable else children
+        return template
+
+    def output_level(k):
+        template = {'id': S('id%d' % k), 'value': S('value%d' % k)}
+        if k + 1 < depth:
+            template['children'] = [output_level(k + 1)]
+        return template
+
+    def data_level(k, i):
+        record = {'id': i, 'value': str(i % 1000) if transforms else i % 1000}
+        if k + 1 < depth and not (nullable and i % 3 == 0):
+            record['children'] = [data_level(k + 1, i * width + j) for j in range(width)]
+        return record
+
+    match_template = match_level(0)
+    output_template = output_level(0)
+    for j in range(joins):
+        # Repeated symbol: only links with the same key as their parent are part of a solution
+        match_template['key'] = S('key')
+        match_template['links%d' % j] = [{'key': S('key'), 'weight': S('weight%d' % j)}]
+        output_template['weights%d' % j] = [S('weight%d' % j)]
+
+    data = []
+    for i in range(n):
+        record = data_level(0, i)
+        if joins:
+            record['key'] = i % 10
+            for j in range(joins):
+                record['links%d' % j] = [{'key': (i + m) % 10, 'weight': m} for m in range(width)]
+        data.append(record)
+    return [match_template], output_template, data
+
+def run_phases(intermediate_class, match_template, output_template, data):
+    # Time each phase separately. Returns (phase timings, rows stored, queries run).
+    timings = {}
+    def phase(name, f, *args):
+        start = time.perf_counter()
+        result = f(*args)
+        timings[name] = time.perf_counter() - start
+        return result
+
+    sqlizer.template_cache.clear()  # Otherwise only the first run would pay for the walk
+    compiled = phase('walk', compile, match_template)
+    intermediate = intermediate_class()
+    phase('build', intermediate.build, compiled.template)
+    phase('append', compiled.solve, data, intermediate)
+    phase('finish', intermediate.finish)
+    rows = sum(intermediate.size(table) for table in intermediate.parents)
+
+    lookups = range(0, len(data), max(1, len(data) // 100))
+    def query():
+        list(intermediate.query([S('id0'), S('value0')]))
+        for i in lookups:
+            list(intermediate.query([S('value0')], {S('id0'): i}))
+    phase('query', query)
+    phase('substitute', lambda: list(substitute(output_template, intermediate)))
+    return timings, rows, len(lookups) + 1
+
+def run(backend, case, n, repeat, memory):
+    match_template, output_template, data = make_case(n, **cases[case])
+    result = {'case': case, 'backend': backend, 'n': n}
+    try:
+        runs = [run_phases(backends[backend], match_template, output_template, data) for i in range(repeat)]
+    except Exception as e:
+        result['error'] = type(e).__name__ + ': ' + str(e)
+        return result
+    # Best of the repeats, per phase
+    timings = {name: min(timing[name] for timing, rows, queries in runs) for name in runs[0][0]}
+    rows, queries = runs[0][1], runs[0][2]
+    result.update({'rows': rows,
+                   'seconds': timings,
+                   'total_seconds': sum(timings.values()),
+                   'rows_per_second': rows / (timings['append'] + timings['finish']),
+                   'queries_per_second': queries / timings['query']})
+    if memory:
+        # Separate run, since tracemalloc slows everything down
+        tracemalloc.start()
+        run_phases(backends[backend], match_template, output_template, data)
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+def get_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+def compare(results, baseline, threshold):
+    # Print the ratio of each phase's time (and peak memory) against the baseline, flagging anything
+    # slower (or bigger) than threshold
+    old = {(r['case'], r['backend'], r['n']): r for r in baseline['results'] if 'error' not in r}
+    regressions = 0
+    for r in results:
+        key = (r['case'], r['backend'], r['n'])
+        if 'error' in r or key not in old:
+            continue
+        ratios = {name: seconds / max(old[key]['seconds'].get(name, 0), 1e-9) for name, seconds in r['seconds'].items()}
+        slow = [name for name, ratio in ratios.items() if ratio > threshold and r['seconds'][name] > 1e-3]
+        if 'peak_bytes' in r and 'peak_bytes' in old[key]:
+            ratios['memory'] = r['peak_bytes'] / max(old[key]['peak_bytes'], 1)
+            if ratios['memory'] > threshold:
+                slow.append('memory')
+        regressions += len(slow)
+        print('%-10s %-8s %s%s' % (r['case'], r['backend'],
+                                   '  '.join('%s %.2fx' % item for item in ratios.items()),
+                                   '  <- worse: ' + ', '.join(slow) if slow else ''))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=2000, help='top-level records per case')
+    parser.add_argument('--cases', default=','.join(cases))
+    parser.add_argument('--backends', default=','.join(backends))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    results = []
+    print('%-10s %-8s %9s %8s %8s %8s %8s %8s %10s %12s %10s' % ('case', 'backend', 'rows', 'walk', 'build', 'append',
+                                                                 'finish', 'query', 'substitute', 'rows/s', 'peak MB'))
+    for case in args.cases.split(','):
+        for backend in args.backends.split(','):
+            r = run(backend, case, args.n, args.repeat, not args.no_memory)
+            results.append(r)
+            if 'error' in r:
+                print('%-10s %-8s failed: %s' % (case, backend, r['error']))
+                continue
+            seconds = r['seconds']
+            print('%-10s %-8s %9d %7.3fs %7.3fs %7.3fs %7.3fs %7.3fs %9.3fs %12.0f %10s' % (
+                case, backend, r['rows'], seconds['walk'], seconds['build'], seconds['append'], seconds['finish'],
+                seconds['query'], seconds['substitute'], r['rows_per_second'],
+                '%.1f' % (r['peak_bytes'] / 1e6) if 'peak_bytes' in r else '-'))
+
+    report = {'version': get_version(), 'python': platform.python_version(), 'timestamp': time.time(),
+              'n': args.n, 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\nCompared to ' + str(baseline.get('version')) + ':')
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,11 @@
-from algex import S, Transform as Trans, Nullable, solve, substitute
+from algex import S, Transform as Trans, Nullable, solve, substitute, compile, transform
+from algex import MemoryIntermediate, PythonIntermediate, NumpyIntermediate, solve_many, substitute_many, iter_json, write_json, write_jsonl
+from algex import solve_concurrently, solve_parallel, IntermediatePool, StatsCollector, async_solve, async_substitute
+from algex.misc import NoMatchException
+from algex.symbol import InternalSymbol
+from algex.intermediate import PandasIntermediate
 
-import random, unittest
+import asyncio, copy, io, json, os, pathlib, pickle, random, subprocess, sys, tempfile, threading, unittest
 
 
 class TestFull(unittest.TestCase):
@@ -162,5 +167,602 @@ class TestFull(unittest.TestCase):
             err = e
         self.assertIsNotNone(err)
 
+    # solve() picks the backend by input size when none is given
+    def test_small_inputs_skip_sqlite(self):
+        self.assertIsInstance(solve({'name': S('name')}, {'name': 'john'}), PythonIntermediate)
+        self.assertIsInstance(solve([S('x')], list(range(10000))), MemoryIntermediate)
+
+class TestSymbol(unittest.TestCase):
+    # Symbols are interned, including through pickling and copying, and have no __dict__
+    def test_interned(self):
+        self.assertIs(S('x'), S('x'))
+        self.assertIs(pickle.loads(pickle.dumps(S('x'))), S('x'))
+        self.assertIs(copy.deepcopy({S('x'): 1}).popitem()[0], S('x'))
+        self.assertIs(InternalSymbol('_parent_id'), InternalSymbol('_parent_id'))
+        self.assertIsNot(InternalSymbol(), InternalSymbol())
+        self.assertIsInstance(pickle.loads(pickle.dumps(InternalSymbol('y'))), InternalSymbol)
+        self.assertEqual(S('x'), InternalSymbol('x'))
+        self.assertEqual(hash(S('x')), hash(InternalSymbol('x')))
+        self.assertFalse(hasattr(S('x'), '__dict__'))
+
+class TestCompile(unittest.TestCase):
+    # Compiled templates should give exactly the same solutions as uncompiled ones
+    def test_compiled_matches_uncompiled(self):
+        data = [{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}]},
+                {'name': 'allan', 'addresses': [{'state': 'CA'}, {'state': 'WA'}]},
+                {'name': 'bob', 'addresses': []}]
+        match_template = [{'name': S('name'), 'addresses': [{'state': S('state')}]}]
+        format_template = {'address': {'state': S('state')}, 'names': [S('name')]}
+
+        compiled = compile(match_template)
+        expected = list(substitute(format_template, solve(match_template, data)))
+        for i in range(2):  # Compiled templates are reusable
+            self.assertEqual(list(substitute(format_template, solve(compiled, data))), expected)
+
+    def test_compiled_transform_and_nullable(self):
+        data = {'state': 'California', 'other': 'x'}
+        template = {'state': Trans(S('state'), inverse={'California': 'CA'}),
+                    'person': Nullable([{'name': S('name')}])}
+
+        m = solve(compile(template), data)
+        self.assertEqual(list(m), [{S('state'): 'CA', S('name'): None}])
+
+    def test_compiled_filter(self):
+        data = [{'name': 'john', 'state': 'CT'}, {'name': 'allan', 'state': 'WA'}]
+        template = [{'name': S('name'), 'state': 'WA'}]
+
+        self.assertEqual(list(solve(compile(template), data)), [{S('name'): 'allan'}])
+
+    # An error inside a nested list (toys missing) is caught by the Nullable around it, on both paths
+    def test_error_inside_nullable(self):
+        data = [{'name': 'john', 'pets': [{'kind': 'cat'}]},
+                {'name': 'allan', 'pets': [{'kind': 'dog', 'toys': [{'toy': 'ball'}]}, {'kind': 'cat'}]}]
+        template = [{'name': S('name'), 'pets': Nullable([{'kind': S('kind'), 'toys': [{'toy': S('toy')}]}])}]
+        format_template = {'name': S('name'), 'pets': [{'kind': S('kind'), 'toys': [S('toy')]}]}
+
+        expected = [{'name': 'john', 'pets': [{'kind': None, 'toys': [None]}]},
+                    {'name': 'allan', 'pets': [{'kind': None, 'toys': [None]}]}]
+        for template in [template, compile(template)]:
+            for intermediate in [MemoryIntermediate(), PythonIntermediate()]:
+                self.assertEqual(list(substitute(format_template, solve(template, data, intermediate))), expected)
+
+    # Repeated queries with the same symbols and known-value keys should reuse one statement
+    def test_statement_cache(self):
+        data = [{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}]},
+                {'name': 'allan', 'addresses': [{'state': 'CA'}, {'state': 'WA'}]}]
+        m = solve([{'name': S('name'), 'addresses': [{'state': S('state')}]}], data, MemoryIntermediate())
+
+        self.assertEqual(list(m.query([S('state')], {S('name'): 'john'})), [{S('state'): 'CA'}, {S('state'): 'CT'}])
+        self.assertEqual(list(m.query([S('state')], {S('name'): 'allan'})), [{S('state'): 'CA'}, {S('state'): 'WA'}])
+        self.assertEqual(list(m.query([S('state')], {S('name'): 'nobody'})), [])
+        self.assertEqual(m.query_cache_info()['misses'], 1)
+        self.assertEqual(m.query_cache_info()['hits'], 2)
+
+    # Indexes come from the template: parent ids, repeated symbols, and symbols used as known values
+    def test_indexes(self):
+        data = [{'name': 'john', 'addresses': [{'state': 'CA'}], 'houses': [{'state': 'CA', 'rooms': 3}]}]
+        m = solve([{'name': S('name'), 'addresses': [{'state': S('state')}], 'houses': [{'state': S('state'), 'rooms': S('rooms')}]}],
+                  data, MemoryIntermediate())
+        indexed = sorted(column_names for model, column_names in m.indexes)
+        self.assertEqual(indexed, [('_parent_id',), ('_parent_id', 'state'), ('_parent_id', 'state')])
+
+        self.assertEqual(list(m.query([S('state')], {S('rooms'): 3})), [{S('state'): 'CA'}])
+        self.assertIn(('rooms',), [column_names for model, column_names in m.indexes])
+
+class TestTemplateInfo(unittest.TestCase):
+    # Table names come from the template's structure, not from object ids
+    def test_stable_table_names(self):
+        def make_template():
+            return [{'name': S('name'), 'addresses': [{'state': S('state')}], 'pets': Nullable([{'kind': S('kind')}])}]
+        data = [{'name': 'john', 'addresses': [{'state': 'CA'}]}]
+        tables = [set(solve(make_template(), data, MemoryIntermediate()).parents) for i in range(2)]
+        self.assertEqual(tables[0], tables[1])
+
+        script = ('from algex import S, Nullable, solve, MemoryIntermediate\n'
+                  'm = solve([{"name": S("name"), "addresses": [{"state": S("state")}], "pets": Nullable([{"kind": S("kind")}])}],'
+                  ' [{"name": "john", "addresses": [{"state": "CA"}]}], MemoryIntermediate())\n'
+                  'print(sorted(table.s for table in m.parents))')
+        output = subprocess.run([sys.executable, '-c', script], check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        self.assertEqual(output.strip(), str(sorted(table.s for table in tables[0])))
+
+    # The same Nullable object used under two different lists fills in its own tables in each
+    def test_shared_nullable(self):
+        pets = Nullable([{'kind': S('kind')}])
+        template = [{'type': 'person', 'name': S('name'), 'pets': pets}, {'type': 'shop', 'owner': S('owner'), 'pets': pets}]
+        data = [{'type': 'person', 'name': 'john'}, {'type': 'shop', 'owner': 'allan', 'pets': [{'kind': 'cat'}]}]
+        m = solve(template, data, MemoryIntermediate())
+        self.assertEqual(len(m.parents), 4)
+        self.assertEqual(sorted(m.size(table) for table in m.parents), [1, 1, 1, 1])
+
+    # Changing a template in place after solving with it shouldn't reuse the old table structure
+    def test_mutated_template(self):
+        template = {'a': S('a')}
+        self.assertEqual(list(solve(template, {'a': 1})), [{S('a'): 1}])
+        template['b'] = S('b')
+        self.assertEqual(list(solve(template, {'a': 1, 'b': 2})), [{S('a'): 1, S('b'): 2}])
+        template['c'] = [{'d': S('d')}]
+        self.assertEqual(list(solve(template, {'a': 1, 'b': 2, 'c': [{'d': 3}]})), [{S('a'): 1, S('b'): 2, S('d'): 3}])
+        template['c'][0]['d'] = S('e')
+        self.assertEqual(list(solve(template, {'a': 1, 'b': 2, 'c': [{'d': 3}]})), [{S('a'): 1, S('b'): 2, S('e'): 3}])
+
+class TestPythonIntermediate(unittest.TestCase):
+    intermediate_class = PythonIntermediate
+
+    # Each intermediate should answer queries exactly like MemoryIntermediate
+    def assertSameResults(self, match_template, data, format_template):
+        expected = list(substitute(format_template, solve(match_template, data, MemoryIntermediate())))
+        result = list(substitute(format_template, solve(match_template, data, self.intermediate_class())))
+        self.assertEqual(result, expected)
+
+    def test_transposition(self):
+        data = [{'name':'john', 'addresses':[{'state':'CA'}, {'state':'CT'}]},
+                {'name': 'allan', 'addresses':[{'state':'CA'}, {'state':'WA'}]}]
+        match_template = [{'name':S('name'), 'addresses':[{'state':S('state')}]}]
+        self.assertSameResults(match_template, data, {'address':{'state':S('state')}, 'names':[S('name')]})
+        self.assertSameResults(match_template, data, [{'name': S('name'), 'state': S('state')}])
+
+    def test_join(self):
+        data = [{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}], 'houses':[{'state': 'CT'}]},
+                {'name': 'allan', 'addresses': [{'state': 'CA'}, {'state': 'WA'}], 'houses':[{'state': 'WA'}]}]
+        match_template = [{'name': S('name'), 'addresses': [{'state': S('state')}], 'houses':[{'state': S('state')}]}]
+        self.assertSameResults(match_template, data, {'name': S('name'), 'states': [S('state')]})
+        self.assertSameResults(match_template, data, {'state': S('state'), 'names': [S('name')]})
+
+    def test_nullable(self):
+        data = [{'name': 'john', 'pets': [{'kind': 'cat'}]}, {'name': 'allan'}]
+        match_template = [{'name': S('name'), 'pets': Nullable([{'kind': S('kind')}])}]
+        self.assertSameResults(match_template, data, {'name': S('name'), 'kinds': [S('kind')]})
+
+    # Equal dicts and lists join on a repeated symbol, same as MemoryIntermediate
+    def test_unhashable_join(self):
+        data = [{'key': {'a': [1]}, 'others': [{'key': {'a': [1]}}, {'key': {'a': [2]}}]},
+                {'key': [3], 'others': [{'key': [3]}]}]
+        self.assertSameResults([{'key': S('key'), 'others': [{'key': S('key')}]}], data, {'key': S('key')})
+        m = solve([{'key': S('key'), 'others': [{'key': S('key')}]}], data, self.intermediate_class())
+        self.assertEqual(list(m.query([S('key')])), [{S('key'): {'a': [1]}}, {S('key'): [3]}])
+
+    # True == 1, so they join and dedup with each other on every backend, whatever the input size
+    def test_bools_equal_ints(self):
+        data = [{'key': True, 'others': [{'key': 1, 'name': 'a'}, {'key': 0, 'name': 'b'}]},
+                {'key': 0, 'others': [{'key': False, 'name': 'c'}]}]
+        match_template = [{'key': S('key'), 'others': [{'key': S('key'), 'name': S('name')}]}]
+        self.assertSameResults(match_template, data, {'name': S('name')})
+        m = solve(match_template, data, self.intermediate_class())
+        self.assertEqual(list(m.query([S('name')])), [{S('name'): 'a'}, {S('name'): 'c'}])
+        self.assertEqual(len(list(m.query([S('key')]))), 2)
+
+    # Values come back with the type they went in with, even when they're equal to another symbol's
+    def test_mixed_types(self):
+        data = [{'price': 1.0, 'active': True, 'count': 1, 'items': [{'count': 1.0}]}]
+        match_template = [{'price': S('price'), 'active': S('active'), 'count': S('count'), 'items': [{'count': S('count')}]}]
+        self.assertSameResults(match_template, data, {'price': S('price'), 'active': S('active')})
+        m = solve(match_template, data, self.intermediate_class())
+        [result] = m.query([S('price'), S('active'), S('count')])
+        self.assertEqual([type(result[s]) for s in [S('price'), S('active'), S('count')]], [float, bool, int])
+        self.assertEqual(list(m.query([S('price')], {S('active'): 1})), [{S('price'): 1.0}])
+
+    # Extending a solved intermediate should give the same results as solving everything at once
+    def test_extend(self):
+        data = [{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}], 'houses': [{'state': 'CT'}]},
+                {'name': 'allan', 'addresses': [{'state': 'CA'}, {'state': 'WA'}], 'houses': [{'state': 'WA'}], 'pets': [{'kind': 'cat'}]},
+                {'name': 'ed', 'addresses': [{'state': 'NY'}], 'houses': [{'state': 'NY'}, {'state': 'CA'}]},
+                {'name': 'zed', 'addresses': [{'state': 'CA'}], 'houses': []},
+                {'name': 'al', 'addresses': [{'state': 'WA'}], 'houses': [{'state': 'WA'}], 'pets': [{'kind': 'dog'}]}]
+        match_template = [{'name': S('name'), 'addresses': [{'state': S('state')}], 'houses': [{'state': S('state')}],
+                           'pets': Nullable([{'kind': S('kind')}])}]
+        format_template = {'state': S('state'), 'people': [{'name': S('name'), 'kinds': [S('kind')]}]}
+
+        expected = list(substitute(format_template, solve(match_template, data, MemoryIntermediate())))
+        for intermediate in [self.intermediate_class(), MemoryIntermediate()]:
+            m = solve(match_template, data[:2], intermediate)
+            self.assertEqual(m.extend(data[2:4]), [{S('name'): 'ed'}])
+            self.assertEqual(m.extend(data[4:]), [{S('name'): 'al'}])
+            self.assertEqual(list(substitute(format_template, m)), expected)
+            self.assertEqual(m.extend([]), [])
+
+class TestPandasIntermediate(TestPythonIntermediate):
+    intermediate_class = PandasIntermediate
+
+    def test_query_frame(self):
+        data = [{'name': 'john', 'pets': [{'kind': 'cat', 'age': 3}, {'kind': 'dog', 'age': None}]}, {'name': 'allan'}]
+        match_template = [{'name': S('name'), 'pets': Nullable([{'kind': S('kind'), 'age': S('age')}])}]
+        m = solve(match_template, data, PandasIntermediate())
+        frame = m.query_frame([S('name'), S('kind'), S('age')])
+        self.assertEqual(list(frame.columns), ['name', 'kind', 'age'])
+        self.assertEqual(list(frame.itertuples(index=False, name=None)),
+                         [('john', 'cat', 3), ('john', 'dog', None), ('allan', None, None)])
+        self.assertEqual(list(m.query([S('name')], {S('age'): None})), [{S('name'): 'john'}, {S('name'): 'allan'}])
+        self.assertEqual(list(m.query([S('kind')], {S('name'): 'john', S('age'): 3})), [{S('kind'): 'cat'}])
+
+class TestNumpyIntermediate(TestPythonIntermediate):
+    # Small chunks, so joins see rows from several of them
+    intermediate_class = staticmethod(lambda: NumpyIntermediate(chunk_size=3))
+
+    def test_random(self):
+        rng = random.Random(0)
+        data = [{'name': 'n%d' % rng.randrange(20), 'tags': [{'tag': rng.randrange(5)} for j in range(rng.randrange(4))],
+                 'orders': [{'tag': rng.randrange(5), 'qty': rng.choice([1, 2, None])} for j in range(rng.randrange(4))]}
+                for i in range(200)]
+        match_template = [{'name': S('name'), 'tags': Nullable([{'tag': S('tag')}]), 'orders': [{'tag': S('tag'), 'qty': S('qty')}]}]
+        self.assertSameResults(match_template, data, {'tag': S('tag'), 'orders': [{'name': S('name'), 'qty': S('qty')}]})
+        python = solve(match_template, data, PythonIntermediate())
+        numpy = solve(match_template, data, NumpyIntermediate())
+        for known_values in [{S('name'): 'n3'}, {S('qty'): None}, {S('tag'): 2, S('qty'): 1}, {S('name'): 'missing'}]:
+            self.assertEqual(list(numpy.query([S('name'), S('qty')], known_values)),
+                             list(python.query([S('name'), S('qty')], known_values)))
+
+class TestBatch(unittest.TestCase):
+    # solve_many() + substitute_many() should match separate solve() + substitute() calls
+    def test_batch_matches_separate_calls(self):
+        docs = [{'names': [{'ssn': 1, 'name': 'mario'}, {'ssn': 2, 'name': 'luigi'}],
+                 'hats': [{'ssn': 1, 'hat_color': 'red'}, {'ssn': 2, 'hat_color': 'green'}]},
+                {'names': [{'ssn': 1, 'name': 'peach'}],
+                 'hats': [{'ssn': 1, 'hat_color': 'pink'}, {'ssn': 2, 'hat_color': 'green'}]}]
+        match_template = {'names': [{'ssn': S('ssn'), 'name':S('name')}],
+                          'hats': [{'ssn': S('ssn'), 'hat_color': S('color')}]}
+        format_template = {'name': S('name'), 'ssn': S('ssn'), 'colors': [S('color')]}
+
+        expected = [list(substitute(format_template, solve(match_template, doc))) for doc in docs]
+        for intermediate in [MemoryIntermediate(), PythonIntermediate()]:
+            m = solve_many(match_template, docs, intermediate)
+            self.assertEqual(list(substitute_many(format_template, m)), expected)
+
+    def test_batch_no_match(self):
+        docs = [[{'name': 'john', 'state': 'WA'}], [{'name': 'allan', 'state': 'CT'}], iter([])]
+        template = [{'name': S('name'), 'state': 'WA'}]
+
+        m = solve_many(template, iter(docs))
+        self.assertEqual(list(substitute_many([S('name')], m)), [[['john']], [], []])
+
+    # An empty batch, or one where nothing matches, still gives one (empty) list per document
+    def test_batch_empty(self):
+        template = [{'name': S('name'), 'state': 'WA'}]
+        for intermediate in [MemoryIntermediate(), PythonIntermediate(), NumpyIntermediate()]:
+            m = solve_many(template, [], intermediate)
+            self.assertEqual(list(substitute_many([S('name')], m)), [])
+        for intermediate in [MemoryIntermediate(), PythonIntermediate(), NumpyIntermediate()]:
+            m = solve_many(template, [[{'name': 'allan', 'state': 'CT'}], []], intermediate)
+            self.assertEqual(list(substitute_many([S('name')], m)), [[], []])
+
+    # A document which matches partway and then fails shouldn't leave rows behind for the next one
+    def test_batch_partial_match(self):
+        docs = [{'names': [{'name': 'a'}], 'hats': []},
+                {'names': [{'name': 'b'}], 'hats': [{'color': 'red'}]},
+                {'names': [{'name': 'c'}, {'name': 'd'}], 'hats': [{'color': 'blue', 'sizes': []}]}]
+        match_template = {'names': [{'name': S('name')}], 'hats': [{'color': S('color'), 'sizes': Nullable([S('size')])}]}
+        format_template = {'name': S('name'), 'colors': [S('color')]}
+
+        for intermediate in [MemoryIntermediate(flush_threshold=1), PythonIntermediate(), NumpyIntermediate(chunk_size=1)]:
+            m = solve_many(match_template, docs, intermediate)
+            self.assertEqual(list(substitute_many(format_template, m)),
+                             [[], [{'name': 'b', 'colors': ['red']}],
+                              [{'name': 'c', 'colors': ['blue']}, {'name': 'd', 'colors': ['blue']}]])
+
+class TestStream(unittest.TestCase):
+    data = [{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}]},
+            {'name': 'allan', 'addresses': [{'state': 'CA'}, {'state': 'WA'}], 'age': 12345},
+            {'name': 'ed', 'addresses': [], 'extra': [True, None, 1.5, 'x\u00e9\n']}]
+
+    def test_iter_json(self):
+        array = json.dumps(self.data, indent=2).encode('utf-8')
+        lines = '\n'.join(json.dumps(record) for record in self.data).encode('utf-8')
+        for chunk_size in [1, 3, 7, 1 << 16]:
+            self.assertEqual(list(iter_json(io.BytesIO(array), chunk_size)), self.data)
+            self.assertEqual(list(iter_json(io.BytesIO(lines), chunk_size)), self.data)
+        self.assertEqual(list(iter_json(io.StringIO('[12, 345]'), 1)), [12, 345])
+        self.assertEqual(list(iter_json(io.BytesIO(b' [ ] '))), [])
+        # Anything after the array is an error, rather than silently dropped
+        for chunk_size in [1, 1 << 16]:
+            self.assertRaises(ValueError, list, iter_json(io.BytesIO(b'[1,2]\n[3]\n'), chunk_size))
+            self.assertRaises(ValueError, list, iter_json(io.BytesIO(b'[1,2] xyz'), chunk_size))
+            self.assertEqual(list(iter_json(io.BytesIO(b'[1,2]\n[3]\n'), chunk_size, lines=True)), [[1, 2], [3]])
+
+    def test_solve_from_file(self):
+        match_template = [{'name': S('name'), 'addresses': [{'state': S('state')}]}]
+        format_template = {'address': {'state': S('state')}, 'names': [S('name')]}
+        expected = list(substitute(format_template, solve(match_template, self.data)))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / 'data.json'
+            path.write_text(json.dumps(self.data))
+            self.assertEqual(list(substitute(format_template, solve(match_template, path))), expected)
+            with open(path, 'rb') as f:
+                self.assertEqual(list(substitute(format_template, solve(match_template, f))), expected)
+
+class TestMemoryIntermediate(unittest.TestCase):
+    # Flushing rows to the db while solving should not change the results
+    def test_flush_threshold(self):
+        data = [{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}], 'houses':[{'state': 'CT'}]},
+                {'name': 'allan', 'addresses': [{'state': 'CA'}, {'state': 'WA'}], 'houses':[{'state': 'WA'}]},
+                {'name': 'ed', 'addresses': [{'state': 'NY'}], 'houses':[{'state': 'NY'}, {'state': 'CA'}]}]
+        match_template = [{'name': S('name'), 'addresses': [{'state': S('state')}], 'houses':[{'state': S('state')}]}]
+        format_template = {'state': S('state'), 'names': [S('name')]}
+
+        expected = list(substitute(format_template, solve(match_template, data, MemoryIntermediate(flush_threshold=None))))
+        for flush_threshold in [1, 2, 5]:
+            m = solve(match_template, data, MemoryIntermediate(flush_threshold=flush_threshold))
+            self.assertEqual(sum(len(rows) for rows in m.cache.values()), 0)
+            self.assertEqual(list(substitute(format_template, m)), expected)
+
+    # Rows are only flushed once their parent row is in the db, so a db enforcing foreign keys accepts them
+    def test_flush_foreign_keys(self):
+        from sqlalchemy import create_engine, event
+        from sqlalchemy.pool import StaticPool
+        data = [{'name': 'p%d' % i, 'pets': [{'kind': 'k%d' % j, 'toys': [{'toy': 't%d' % k} for k in range(2)]} for j in range(3)]}
+                for i in range(5)]
+        data.append({'name': 'nobody', 'pets': [{'kind': 'cat', 'toys': []}]})
+        match_template = [{'name': S('name'), 'pets': [{'kind': S('kind'), 'toys': [{'toy': S('toy')}]}]}]
+        format_template = {'name': S('name'), 'pets': [{'kind': S('kind'), 'toys': [S('toy')]}]}
+
+        expected = list(substitute(format_template, solve(match_template, data, MemoryIntermediate(flush_threshold=None))))
+        for flush_threshold in [1, 2, 5]:
+            engine = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+            event.listen(engine, 'connect', lambda connection, record: connection.execute('PRAGMA foreign_keys=ON'))
+            m = solve(match_template, data, MemoryIntermediate(engine=engine, flush_threshold=flush_threshold))
+            self.assertEqual(list(substitute(format_template, m)), expected)
+
+    # Pruning rows without join partners should not change the results
+    def test_prune(self):
+        data = [{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}], 'houses':[{'state': 'CT', 'rooms': [1, 2]}]},
+                {'name': 'allan', 'addresses': [{'state': 'CA'}, {'state': 'WA'}], 'houses':[{'state': 'WA', 'rooms': [3]}]},
+                {'name': 'ed', 'addresses': [{'state': 'NY'}], 'houses':[{'state': 'CA', 'rooms': [4, 5]}]}]
+        match_template = [{'name': S('name'), 'addresses': [{'state': S('state')}],
+                           'houses':[{'state': S('state'), 'rooms': [S('room')]}]}]
+        format_template = {'state': S('state'), 'names': [S('name')], 'rooms': [S('room')]}
+
+        expected = list(substitute(format_template, solve(match_template, data, MemoryIntermediate())))
+        m = solve(match_template, data, MemoryIntermediate(prune=True, flush_threshold=1))
+        self.assertEqual(list(substitute(format_template, m)), expected)
+        # ed has no address matching a house, so ed, the address, the house and its rooms all go, as do
+        # john's and allan's CA addresses
+        self.assertEqual(m.pruned, 7)
+        self.assertEqual(list(m.query([S('name')])), [{S('name'): 'john'}, {S('name'): 'allan'}])
+        self.assertRaises(ValueError, m.extend, data)
+
+    # Primitives are stored natively; anything else round-trips through per-symbol side tables
+    def test_value_encoding(self):
+        values = [0, 1, -5, 2 ** 70, 1.5, float('nan'), '', 'x', None, b'raw', (1, 2),
+                  [1, [2]], {'a': [1]}, {1, 2}, object()]
+        data = [{'value': value, 'tags': [{'value': value}]} for value in values]
+        m = solve([{'value': S('value'), 'tags': [{'value': S('value')}]}], data, MemoryIntermediate())
+        results = [solution[S('value')] for solution in m.query([S('value')])]
+        self.assertEqual(len(results), len(values))
+        for result, value in zip(results, values):
+            if value == value:
+                self.assertEqual(result, value)
+            self.assertIs(type(result), type(value))
+
+        # bools come back as bools, as long as the symbol doesn't hold ints too
+        m = solve([{'flag': S('flag'), 'n': S('n')}], [{'flag': True, 'n': True}, {'flag': False, 'n': 1}], MemoryIntermediate())
+        self.assertEqual([type(solution[S('flag')]) for solution in m.query([S('flag')])], [bool, bool])
+        self.assertEqual(list(m.query([S('n')])), [{S('n'): 1}])
+
+        # Equal dicts and lists join on a repeated symbol, even though they're unhashable
+        data = [{'key': {'a': [1]}, 'others': [{'key': {'a': [1]}}, {'key': {'a': [2]}}]}]
+        m = solve([{'key': S('key'), 'others': [{'key': S('key')}]}], data, MemoryIntermediate())
+        self.assertEqual(list(m.query([S('key')])), [{S('key'): {'a': [1]}}])
+
+        # Known values of native types are compared by sqlite directly, so they can use an index
+        m = solve([{'n': S('n'), 'name': S('name')}], [{'n': i, 'name': str(i)} for i in range(100)], MemoryIntermediate())
+        self.assertEqual(list(m.query([S('name')], {S('n'): 42})), [{S('name'): '42'}])
+        self.assertEqual(m.get_statement([S('name')], {S('n'): 42})[1], {'known_0': 42})
+
+    # A saved intermediate can be reopened, in another process, and substituted without re-solving
+    def test_save_and_open(self):
+        data = [{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}], 'houses':[{'state': 'CT'}]},
+                {'name': 'allan', 'addresses': [{'state': 'CA'}, {'state': 'WA'}], 'houses':[{'state': 'WA'}]}]
+        match_template = [{'name': S('name'), 'addresses': [{'state': S('state')}], 'houses':[{'state': S('state')}]}]
+        format_template = {'state': S('state'), 'names': [S('name')]}
+        m = solve(match_template, data, MemoryIntermediate())
+        expected = list(substitute(format_template, m))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'solved.db')
+            m.save(path)
+            reopened = MemoryIntermediate.open(path)
+            self.assertEqual(list(substitute(format_template, reopened)), expected)
+            reopened.session.close()
+
+            script = ('import sys, json\n'
+                      'from algex import S, substitute, MemoryIntermediate\n'
+                      'm = MemoryIntermediate.open(sys.argv[1])\n'
+                      'print(json.dumps(list(substitute({"state": S("state"), "names": [S("name")]}, m))))')
+            output = subprocess.run([sys.executable, '-c', script, path], check=True, capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+            self.assertEqual(json.loads(output), expected)
+
+class TestSubstitute(unittest.TestCase):
+    # Nested list templates should be fetched with one query per level, not one per solution
+    def test_one_query_per_level(self):
+        data = [{'name': 'john', 'orders': [{'sku': 'x', 'lines': [{'qty': 1}, {'qty': 2}]}, {'sku': 'y', 'lines': [{'qty': 1}]}]},
+                {'name': 'allan', 'orders': [{'sku': 'x', 'lines': [{'qty': 3}]}]}]
+        match_template = [{'name': S('name'), 'orders': [{'sku': S('sku'), 'lines': [{'qty': S('qty')}]}]}]
+        format_template = {'name': S('name'), 'skus': [{'sku': S('sku'), 'qtys': [S('qty')]}]}
+        expected = [{'name': 'john', 'skus': [{'sku': 'x', 'qtys': [1, 2]}, {'sku': 'y', 'qtys': [1]}]},
+                    {'name': 'allan', 'skus': [{'sku': 'x', 'qtys': [3]}]}]
+
+        for intermediate in [MemoryIntermediate(), PythonIntermediate()]:
+            m = solve(match_template, data, intermediate)
+            queries = []
+            query = m.query
+            m.query = lambda symbols, known_values: queries.append(symbols) or query(symbols, known_values)
+            self.assertEqual(list(substitute(format_template, m)), expected)
+            self.assertEqual(len(queries), 3)
+
+    # Grouped queries should give nested lists in the same (data) order as one query per solution
+    def test_grouped_order(self):
+        rng = random.Random(1)
+        data = [{'name': 'n%d' % i, 'orders': [{'sku': 's%d' % rng.randrange(6), 'lines': [{'qty': rng.randrange(10)} for k in range(rng.randrange(1, 4))]}
+                                               for j in range(rng.randrange(1, 5))]} for i in range(30)]
+        match_template = [{'name': S('name'), 'orders': [{'sku': S('sku'), 'lines': [{'qty': S('qty')}]}]}]
+        format_template = {'name': S('name'), 'skus': [{'sku': S('sku'), 'qtys': [S('qty')]}]}
+        def materialize(result):
+            return {'name': result['name'], 'skus': [{'sku': sku['sku'], 'qtys': list(sku['qtys'])} for sku in result['skus']]}
+
+        for intermediate in [MemoryIntermediate(), PythonIntermediate(), NumpyIntermediate()]:
+            m = solve(match_template, data, intermediate)
+            per_row = [materialize(result) for result in substitute(format_template, m, lazy=True)]
+            self.assertEqual(list(substitute(format_template, m)), per_row)
+            self.assertEqual(per_row[0]['name'], 'n0')
+
+    def test_lazy_substitute(self):
+        data = [{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}]},
+                {'name': 'allan', 'addresses': [{'state': 'CA'}, {'state': 'WA'}]}]
+        match_template = [{'name': S('name'), 'addresses': [{'state': S('state')}]}]
+        format_template = {'state': S('state'), 'names': [{'name': S('name'), 'states': [S('state')]}]}
+        m = solve(match_template, data)
+        expected = list(substitute(format_template, m))
+
+        results = list(substitute(format_template, m, lazy=True))
+        self.assertNotIsInstance(results[0]['names'], list)
+
+        out = io.StringIO()
+        write_json(substitute(format_template, m, lazy=True), out)
+        self.assertEqual(json.loads(out.getvalue()), expected)
+
+        out = io.StringIO()
+        write_jsonl(substitute(format_template, m, lazy=True), out)
+        self.assertEqual([json.loads(line) for line in out.getvalue().splitlines()], expected)
+
+class TestConcurrency(unittest.TestCase):
+    match_template = [{'name': S('name'), 'addresses': Nullable([{'state': S('state')}])}]
+    format_template = {'state': S('state'), 'names': [S('name')]}
+
+    def make_doc(self, i):
+        return [{'name': 'person%d' % i, 'addresses': [{'state': 'S%d' % (i % 3)}, {'state': 'S%d' % i}]},
+                {'name': 'other%d' % i}]
+
+    # Solving from several threads at once shouldn't mix up anyone's results
+    def test_threads(self):
+        expected = {i: list(substitute(self.format_template, solve(self.match_template, self.make_doc(i), MemoryIntermediate())))
+                    for i in range(8)}
+        errors = []
+        def work(i):
+            for j in range(10):
+                for intermediate in [MemoryIntermediate(), PythonIntermediate()]:
+                    m = solve(self.match_template, self.make_doc(i), intermediate)
+                    if list(substitute(self.format_template, m)) != expected[i]:
+                        errors.append(i)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_solve_concurrently(self):
+        docs = [self.make_doc(i) for i in range(20)]
+        expected = [list(substitute(self.format_template, solve(self.match_template, doc))) for doc in docs]
+        self.assertEqual(list(solve_concurrently(self.match_template, iter(docs), self.format_template, max_workers=4)), expected)
+        self.assertEqual([list(substitute(self.format_template, m)) for m in solve_concurrently(self.match_template, docs)], expected)
+
+    # Sharding the top-level list across processes should be query-equivalent to a serial solve
+    def test_solve_parallel(self):
+        data = [{'name': 'p%d' % i, 'addresses': [{'state': 'S%d' % (i % 3)}, {'state': 'S%d' % (i % 5)}],
+                 'houses': [{'state': 'S%d' % (i % 4)}], 'tag': 'x'} for i in range(25)]
+        data.append({'name': 'filtered', 'addresses': [{'state': 'S1'}], 'houses': [{'state': 'S1'}], 'tag': 'y'})
+        match_template = [{'name': S('name'), 'addresses': [{'state': S('state')}], 'houses': [{'state': S('state')}],
+                           'tag': 'x', 'pets': Nullable([{'kind': S('kind')}])}]
+        format_template = {'state': S('state'), 'names': [{'name': S('name'), 'kinds': [S('kind')]}]}
+
+        expected = list(substitute(format_template, solve(match_template, data, MemoryIntermediate())))
+        for chunk_size in [1, 4, 100]:
+            m = solve_parallel(match_template, data, processes=2, chunk_size=chunk_size)
+            self.assertEqual(sorted(map(repr, substitute(format_template, m))), sorted(map(repr, expected)))
+
+    # Async iterables anywhere in the data, e.g. paginated responses, solve the same as lists
+    def test_async(self):
+        docs = [self.make_doc(i) for i in range(6)]
+        async def pages(items, size=2):
+            for i in range(0, len(items), size):
+                await asyncio.sleep(0)  # Stand-in for fetching a page
+                for item in items[i:i + size]:
+                    yield item
+        def nested(doc):
+            return [dict(person, addresses=pages(person['addresses'], 1)) if 'addresses' in person else person
+                    for person in doc]
+
+        async def run(intermediate):
+            m = await async_solve(self.match_template, pages([person for doc in docs for person in nested(doc)]), intermediate)
+            return [result async for result in async_substitute(self.format_template, m, batch_size=2)]
+        expected = list(substitute(self.format_template, solve(self.match_template, sum(docs, []), MemoryIntermediate())))
+        for intermediate in [MemoryIntermediate(), PythonIntermediate()]:
+            self.assertEqual(asyncio.run(run(intermediate)), expected)
+
+class TestTransform(unittest.TestCase):
+    # transform() should give exactly what solve() + substitute() gives, whether or not it takes the direct path
+    def test_transform(self):
+        data = [{'name': 'john', 'age': '30', 'orders': [{'sku': 'x', 'lines': [{'qty': 1}, {'qty': 2}]}, {'sku': 'y'}],
+                 'pets': [{'kind': 'cat'}]},
+                {'name': 'allan', 'age': '40', 'orders': [{'sku': 'x', 'lines': [{'qty': 1}]}]},
+                {'name': 'john', 'age': '30', 'orders': [{'sku': 'z', 'lines': []}]}]
+        match_template = [{'name': S('name'), 'age': Trans(S('age'), str, int),
+                           'orders': [{'sku': S('sku'), 'lines': Nullable([{'qty': S('qty')}])}],
+                           'pets': Nullable([{'kind': S('kind')}])}]
+        cases = [({'name': S('name'), 'age': Trans(S('age'), lambda age: age + 1), 'orders': [{'sku': S('sku'), 'qtys': [S('qty')]}]}, True),
+                 ({'sku': S('sku'), 'names': [S('name')]}, True),
+                 ({'name': S('name'), 'kinds': [S('kind')], 'skus': [S('sku')]}, True),
+                 ({'kind': S('kind'), 'skus': [S('sku')]}, False),  # pets and orders are different branches
+                 ('constant', True)]
+        for output_template, direct in cases:
+            f = transform(match_template, output_template)
+            self.assertEqual(f.direct, direct)
+            self.assertEqual(f(data), list(substitute(output_template, solve(match_template, data, PythonIntermediate()))))
+
+        # Repeated symbols need joins
+        join_template = [{'name': S('name'), 'addresses': [{'state': S('state')}], 'houses': [{'state': S('state')}]}]
+        f = transform(join_template, {'state': S('state'), 'names': [S('name')]})
+        self.assertFalse(f.direct)
+        self.assertEqual(f([{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}], 'houses':[{'state': 'CT'}]}]),
+                         [{'state': 'CT', 'names': ['john']}])
+
+class TestInstrument(unittest.TestCase):
+    # StatsCollector sees phases, row counts, queries, filtered elements and Nullable fallbacks
+    def test_stats_collector(self):
+        match_template = [{'type': 'person', 'name': S('name'), 'pets': Nullable([{'kind': S('kind')}])}]
+        data = [{'type': 'person', 'name': 'john', 'pets': [{'kind': 'cat'}]}, {'type': 'person', 'name': 'allan'},
+                {'type': 'shop', 'name': 'pets r us'}]
+        stats = StatsCollector(explain=True)
+        for template in [match_template, compile(match_template)]:
+            intermediate = MemoryIntermediate()
+            intermediate.observe(stats)
+            solve(template, data, intermediate)
+            self.assertEqual(list(substitute({'name': S('name'), 'kinds': [S('kind')]}, intermediate)),
+                             [{'name': 'john', 'kinds': ['cat']}, {'name': 'allan', 'kinds': [None]}])
+
+        summary, = stats.summary()
+        self.assertEqual(summary['solves'], 2)
+        self.assertEqual(sorted(summary['rows'].values()), [4, 4])
+        self.assertEqual(summary['no_matches'], 2)
+        self.assertEqual(summary['errors_handled'], 2)
+        self.assertEqual(set(summary['phase_seconds']), {'build', 'solve', 'finish', 'flush', 'index'})
+        self.assertEqual(summary['queries'], 4)
+        self.assertTrue(all('SELECT' in sql for sql in summary['query_plans']))
+        self.assertTrue(all(plan for plan in summary['query_plans'].values()))
+
+class TestPool(unittest.TestCase):
+    # Pooled intermediates are reused between solves, and give the same results as fresh ones
+    def test_pool(self):
+        match_template = [{'name': S('name'), 'addresses': [{'state': S('state')}], 'houses':[{'state': S('state')}]}]
+        format_template = {'state': S('state'), 'names': [S('name')]}
+        docs = [[{'name': 'john', 'addresses': [{'state': 'CA'}, {'state': 'CT'}], 'houses':[{'state': 'CT'}]}],
+                [{'name': 'allan', 'addresses': [{'state': 'CA'}, {'state': 'WA'}], 'houses':[{'state': 'WA'}]}],
+                [{'name': 'ed', 'addresses': [{'state': 'NY'}], 'houses':[]}]]
+        pool = IntermediatePool()
+        intermediates = set()
+        for doc in docs * 2:
+            if not doc[0]['houses']:
+                # Intermediate still goes back to the pool if there's no match
+                self.assertRaises(NoMatchException, pool.solve(match_template, doc).__enter__)
+                continue
+            expected = list(substitute(format_template, solve(match_template, doc, MemoryIntermediate())))
+            with pool.solve(match_template, doc) as solutions:
+                intermediates.add(id(solutions))
+                self.assertEqual(list(substitute(format_template, solutions)), expected)
+        self.assertEqual(len(intermediates), 1)
+        self.assertEqual(pool.stats()['hits'], 5)
+        self.assertEqual(pool.stats()['misses'], 1)
+
 if __name__ == '__main__':
     unittest.main(module='test')